@@ -1,14 +1,72 @@
+import hmac
+from os import getenv
+
 import uvicorn
 from starlette.applications import Starlette
 from starlette.middleware import Middleware
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.requests import Request
+from starlette.responses import Response, RedirectResponse
+from starlette.routing import Route
 from starlette.templating import Jinja2Templates
 from starlette_admin.contrib.sqla import Admin, ModelView
+from starlette_admin.views import CustomView
 
+import metrics
+import profiler
 from login import UsernameAndPasswordProvider
-from models import engine, User, Salon, Barber, Appointment, Service, BarberAvailability, BarberService
+from models import engine, User, Salon, Barber, Appointment, Service, BarberAvailability, BarberService, \
+    ScheduleTemplate, ScheduleException
+
+
+METRICS_TOKEN = getenv('METRICS_TOKEN')  # Bearer token of the scraper, /metrics is not served without one
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    # Handler names, traffic and the booking funnel are not for everyone
+    if not hmac.compare_digest(request.headers.get('authorization', ''), f'Bearer {METRICS_TOKEN}'):
+        return Response(status_code=401, headers={'WWW-Authenticate': 'Bearer'})
+    # Summed over every bot process that exported to METRICS_DIR, see metrics.py
+    return Response(metrics.render(metrics.collect()), media_type='text/plain; version=0.0.4')
+
+
+class ProfilesView(CustomView):
+    """Switches the update profiler of the bot processes and shows what it collected, see profiler.py."""
+
+    async def render(self, request: Request, templates: Jinja2Templates) -> Response:
+        if request.method == 'POST':
+            form = await request.form()
+            if form.get('action') == 'clear':
+                profiler.clear()
+            else:
+                try:
+                    rate = min(max(float(form.get('rate') or 0), 0.0), 1.0)
+                except ValueError:
+                    rate = 0.0
+                profiler.write_settings(profiler.Settings(rate, form.get('handler') or None))
+            return RedirectResponse(request.url, status_code=303)
+
+        handler = request.query_params.get('handler')
+        return templates.TemplateResponse(self.template_path, {
+            'request': request,
+            'title': self.title(request),
+            'settings': profiler.read_settings(),
+            'summaries': profiler.summaries(),
+            'handler': handler,
+            'report': profiler.report(handler) if handler else ''
+        })
+
+
+metrics_routes = [Route('/metrics', metrics_endpoint, methods=['GET'])] if METRICS_TOKEN else []
+
+# The bot webhook can be served next to the admin panel (SERVE_WEBHOOK=1) or on its own with `uvicorn webhook:app`;
+# either way by a single process, see webhook.py
+if getenv('SERVE_WEBHOOK'):
+    from webhook import routes, lifespan
 
-app = Starlette()
+    app = Starlette(routes=metrics_routes + routes, lifespan=lifespan)
+else:
+    app = Starlette(routes=metrics_routes)
 
 # Configure Jinja2 templates
 templates = Jinja2Templates(directory="templates")
@@ -26,8 +84,13 @@ admin.add_view(ModelView(Salon, icon='fas fa-user'))
 admin.add_view(ModelView(Barber, icon='fas fa-user'))
 admin.add_view(ModelView(Appointment, icon='fas fa-user'))
 admin.add_view(ModelView(Service, icon='fas fa-user'))
+admin.add_view(ModelView(ScheduleTemplate, icon='fas fa-calendar-week'))
+admin.add_view(ModelView(ScheduleException, icon='fas fa-calendar-xmark'))
 admin.add_view(ModelView(BarberAvailability, icon='fas fa-user'))
 admin.add_view(ModelView(BarberService, icon='fas fa-user'))
+admin.add_view(ProfilesView(
+    'Profiles', icon='fas fa-stopwatch', path='/profiles', template_path='profiles.html', methods=['GET', 'POST']
+))
 
 admin.mount_to(app)
 
@@ -0,0 +1,390 @@
+import time as monotonic_time
+from bisect import bisect_left
+from datetime import date, datetime, time, timedelta
+from os import getenv
+from typing import NamedTuple
+
+from sqlalchemy import select, literal, cast, Text, union_all, func, and_, null, Date, Time, Integer
+from sqlalchemy.dialects.postgresql import BIT
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from catalog import catalog
+from intervals import Intervals
+from models import BarberSchedule, Appointment, Barber, SlotHold, ScheduleTemplate, ScheduleException, SLOT_MINUTES, \
+    DAY_SLOTS, MAX_SERVICE_MINUTES
+
+SLOT_TTL = 60  # seconds, bounds staleness of edits made by other processes
+MAX_ENTRIES = 10_000
+CALENDAR_DAYS = int(getenv('CALENDAR_DAYS', 6))
+ONE_OFF_SLOTS = 4  # A one-off BarberAvailability slot stays open until the next one, an hour at most
+
+
+def to_minute(value: time) -> int:
+    return value.hour * 60 + value.minute
+
+
+def format_minute(minute: int) -> str:
+    return f'{minute // 60:02d}:{minute % 60:02d}'
+
+
+def slot_of(value: time) -> int | None:
+    """Bit of the slot starting at `value`, None between slots."""
+    quarter, rest = divmod(to_minute(value), SLOT_MINUTES)
+    return None if rest or value.second else quarter
+
+
+def parse_bits(bits: str | None) -> int:
+    """BIT(DAY_SLOTS) as text, its first character is bit 0."""
+    return int(bits[::-1], 2) if bits else 0
+
+
+def week_start(day: date) -> date:
+    return day - timedelta(days=day.weekday())
+
+
+def slot_mask(start: time, end: time, step: int) -> int:
+    """Slots every `step` minutes from `start` until `end`; those off the SLOT_MINUTES grid are left out."""
+    mask = 0
+    for minute in range(to_minute(start), to_minute(end), step):
+        if minute % SLOT_MINUTES == 0:
+            mask |= 1 << minute // SLOT_MINUTES
+    return mask
+
+
+def hours_mask(start: time, end: time) -> int:
+    """The SLOT_MINUTES periods lying wholly within [start, end)."""
+    first = -(-to_minute(start) // SLOT_MINUTES)
+    last = to_minute(end) // SLOT_MINUTES
+    return (1 << last) - (1 << first) if last > first else 0
+
+
+def one_off_hours(starts: int) -> int:
+    numbers = list(slot_numbers(starts))
+    mask = 0
+    for slot, following in zip(numbers, numbers[1:] + [DAY_SLOTS]):
+        mask |= ((1 << min(following - slot, ONE_OFF_SLOTS)) - 1) << slot
+    return mask
+
+
+def hours_cover(model: type[ScheduleTemplate] | type[ScheduleException], value: time):
+    """SQL counterpart of slot_mask: the template or exception row has a slot starting at `value`."""
+    start_minute = cast(func.extract('epoch', model.start_time), Integer) // 60
+    return and_(
+        model.start_time <= value,
+        model.end_time > value,
+        (literal(to_minute(value)) - start_minute) % model.slot_minutes == 0
+    )
+
+
+def quarters_bits(first, last):
+    """BIT(DAY_SLOTS) with the bits from `first` until `last` set, SQL counterpart of (1 << last) - (1 << first)."""
+    ones = cast(literal('1' * DAY_SLOTS), BIT(DAY_SLOTS))
+    return ones.op('>>')(first).op('&')(ones.op('>>')(last).op('#')(ones))
+
+
+def hours_bits(model: type[ScheduleTemplate] | type[ScheduleException]):
+    """SQL counterpart of hours_mask for the hours of the template or exception row, NULL on a day off."""
+    start_minute = cast(func.extract('epoch', model.start_time), Integer) // 60
+    end_minute = cast(func.extract('epoch', model.end_time), Integer) // 60
+    return quarters_bits((start_minute + SLOT_MINUTES - 1) // SLOT_MINUTES, end_minute // SLOT_MINUTES)
+
+
+def one_off_hours_bits(starts):
+    """SQL counterpart of one_off_hours: each slot open for ONE_OFF_SLOTS periods, or until the next one."""
+    hours = starts
+    for shift in range(1, ONE_OFF_SLOTS):
+        hours = hours.op('|')(starts.op('>>')(shift))
+    return hours
+
+
+def slot_numbers(mask: int):
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
+def runs(mask: int):
+    """[start, end) minutes of every run of set bits."""
+    while mask:
+        first = (mask & -mask).bit_length() - 1
+        rest = mask >> first
+        length = (~rest & (rest + 1)).bit_length() - 1
+        yield first * SLOT_MINUTES, (first + length) * SLOT_MINUTES
+        mask &= ~((1 << first + length) - 1)
+
+
+class DaySchedule(NamedTuple):
+    starts: int  # Bit n set when a slot starts at the n-th quarter hour
+    hours: int  # Bit n set when the barber works through the n-th quarter hour
+
+
+def taken_intervals(rows, day: date) -> Intervals:
+    """Appointments and holds as minutes of the day, those running over midnight clipped by the day."""
+    day_start = datetime.combine(day, time.min)
+    return Intervals(
+        (int((start - day_start).total_seconds()) // 60, -(-int((end - day_start).total_seconds()) // 60))
+        for start, end in rows
+    )
+
+
+class DaySlots:
+    """Slot starts, working hours and taken intervals of one barber on one day."""
+
+    __slots__ = ('starts', 'hours', 'taken', 'loaded_at')
+
+    def __init__(self, schedule: DaySchedule, taken: Intervals):
+        self.starts = [slot * SLOT_MINUTES for slot in slot_numbers(schedule.starts)]
+        self.hours = Intervals(runs(schedule.hours))
+        self.taken = taken
+        self.loaded_at = monotonic_time.monotonic()
+
+    def fits(self, start: int, duration: int) -> bool:
+        """[start, start + duration) is in the working hours and overlaps nothing taken, two binary searches."""
+        end = start + duration
+        return self.hours.covers(start, end) and not self.taken.overlaps(start, end)
+
+    def bookable(self, duration=SLOT_MINUTES) -> list[int]:
+        return [start for start in self.starts if self.fits(start, duration)]
+
+    def offers(self, value: time, duration=SLOT_MINUTES) -> bool:
+        """A slot starts at `value` and the barber works until its end, whatever is taken."""
+        start = to_minute(value)
+        index = bisect_left(self.starts, start)
+        found = slot_of(value) is not None and index < len(self.starts) and self.starts[index] == start
+        return found and self.hours.covers(start, start + duration)
+
+    def times(self, duration=SLOT_MINUTES) -> list[str]:
+        return [format_minute(start) for start in self.bookable(duration)]
+
+
+class SlotIndex:
+    """Cache of free slots keyed by (barber_id, day).
+
+    Each entry is built by one date-bounded query and must be invalidated whenever
+    an appointment of that barber and day is created or cancelled.
+    """
+
+    def __init__(self, ttl=SLOT_TTL):
+        self.ttl = ttl
+        self._days: dict[tuple[int, date], DaySlots] = {}
+
+    async def get(self, session: AsyncSession, barber_id: int, day: date) -> DaySlots:
+        slots = self._days.get((barber_id, day))
+        if slots is None or monotonic_time.monotonic() - slots.loaded_at > self.ttl:
+            slots = (await self._load(session, [barber_id], day))[barber_id]
+        return slots
+
+    async def free_times(self, session: AsyncSession, barber_id: int, day: date, duration=SLOT_MINUTES) -> list[str]:
+        return (await self.get(session, barber_id, day)).times(duration)
+
+    async def offers(self, session: AsyncSession, barber_id: int, moment: datetime, duration=SLOT_MINUTES) -> bool:
+        return (await self.get(session, barber_id, moment.date())).offers(moment.time(), duration)
+
+    async def get_salon(self, session: AsyncSession, salon_id: int, day: date) -> list[tuple[Barber, DaySlots]]:
+        """Slots of every barber of the salon, loading all stale entries with one query."""
+        barbers = (await session.scalars(
+            select(Barber).filter(Barber.salon_id == salon_id).order_by(Barber.id)
+        )).all()
+
+        now = monotonic_time.monotonic()
+        # Taken before the load, whose stores may evict entries that expire meanwhile
+        fresh = {barber.id: self._days[(barber.id, day)] for barber in barbers
+                 if (barber.id, day) in self._days and now - self._days[(barber.id, day)].loaded_at <= self.ttl}
+        stale = [barber.id for barber in barbers if barber.id not in fresh]
+        if stale:
+            fresh.update(await self._load(session, stale, day))
+
+        return [(barber, fresh[barber.id]) for barber in barbers]
+
+    def invalidate(self, barber_id: int, day: date):
+        self._days.pop((barber_id, day), None)
+
+    def clear(self):
+        self._days.clear()
+
+    async def _load(self, session: AsyncSession, barber_ids: list[int], day: date) -> dict[int, DaySlots]:
+        scheduled = await week_schedules.days(session, barber_ids, day, day + timedelta(days=1))
+        taken = {barber_id: [] for barber_id in barber_ids}
+        for barber_id, start, end in await session.execute(taken_query(barber_ids, day)):
+            taken[barber_id].append((start, end))
+
+        loaded = {}
+        for barber_id in barber_ids:
+            schedule = scheduled[barber_id].get(day, DaySchedule(0, 0))
+            loaded[barber_id] = DaySlots(schedule, taken_intervals(taken[barber_id], day))
+            self._store(barber_id, day, loaded[barber_id])
+        return loaded
+
+    def _store(self, barber_id: int, day: date, slots: DaySlots):
+        if len(self._days) >= MAX_ENTRIES:
+            now = monotonic_time.monotonic()
+            self._days = {key: value for key, value in self._days.items() if now - value.loaded_at <= self.ttl}
+        self._days[(barber_id, day)] = slots
+
+
+def merge(first: DaySchedule | None, second: DaySchedule | None) -> DaySchedule | None:
+    if first is None or second is None:
+        return first or second
+    return DaySchedule(first.starts | second.starts, first.hours | second.hours)
+
+
+class ExpandedWeek:
+    __slots__ = ('days', 'version', 'loaded_at')
+
+    def __init__(self, days: dict[date, DaySchedule], version: int | None):
+        self.days = days  # Only the days that have slots
+        self.version = version
+        self.loaded_at = monotonic_time.monotonic()
+
+
+class WeekSchedules:
+    """Scheduled slots per day, cached per (barber_id, week starting on Monday).
+
+    A week is expanded from the barber's ScheduleTemplate rows, with ScheduleException rows
+    replacing the templates on their days, plus the BarberSchedule bitmaps of one-off
+    BarberAvailability rows. Nothing of it is stored in the database. Templates and
+    exceptions bump the catalog version, which retires every cached week; the TTL bounds
+    the staleness of the one-off rows.
+    """
+
+    def __init__(self, ttl=SLOT_TTL):
+        self.ttl = ttl
+        self._weeks: dict[tuple[int, date], ExpandedWeek] = {}
+
+    async def days(self, session: AsyncSession, barber_ids: list[int], start: date,
+                   end: date) -> dict[int, dict[date, DaySchedule]]:
+        """Scheduled slots of the barbers from `start` until `end`, loading all stale weeks with one query."""
+        mondays = [week_start(start) + timedelta(weeks=index)
+                   for index in range((end - week_start(start) + timedelta(days=6)).days // 7)]
+        now = monotonic_time.monotonic()
+        stale = {barber_id for barber_id in barber_ids for monday in mondays if not self._fresh(barber_id, monday, now)}
+        # Taken before the load, whose stores may evict entries that expire meanwhile
+        weeks = {(barber_id, monday): self._weeks[(barber_id, monday)]
+                 for barber_id in barber_ids if barber_id not in stale for monday in mondays}
+        if stale:
+            weeks.update(await self._load(session, sorted(stale), mondays))
+
+        result = {}
+        for barber_id in barber_ids:
+            result[barber_id] = {day: schedule for monday in mondays
+                                 for day, schedule in weeks[(barber_id, monday)].days.items() if start <= day < end}
+        return result
+
+    def clear(self):
+        self._weeks.clear()
+
+    def _fresh(self, barber_id: int, monday: date, now: float) -> bool:
+        week = self._weeks.get((barber_id, monday))
+        return week is not None and week.version == catalog.version and now - week.loaded_at <= self.ttl
+
+    async def _load(self, session: AsyncSession, barber_ids: list[int],
+                    mondays: list[date]) -> dict[tuple[int, date], ExpandedWeek]:
+        version = catalog.version
+        templates, exceptions, one_off = {}, {}, {}
+        for kind, barber_id, day, weekday, start, end, step, bits in await session.execute(
+                week_query(barber_ids, mondays[0], mondays[-1] + timedelta(days=7))):
+            if kind == 'one_off':
+                starts = parse_bits(bits)
+                one_off[(barber_id, day)] = DaySchedule(starts, one_off_hours(starts))
+                continue
+            # A day off has no hours, its exception still hides the templates
+            schedule = DaySchedule(slot_mask(start, end, step), hours_mask(start, end)) if start and end else None
+            target, key = (templates, (barber_id, weekday)) if kind == 'template' else (exceptions, (barber_id, day))
+            target[key] = merge(target.get(key), schedule)
+
+        loaded = {}
+        for barber_id in barber_ids:
+            for monday in mondays:
+                days = {}
+                for day in (monday + timedelta(days=offset) for offset in range(7)):
+                    if (barber_id, day) in exceptions:
+                        schedule = exceptions[(barber_id, day)]
+                    else:
+                        schedule = templates.get((barber_id, day.weekday()))
+                    schedule = merge(schedule, one_off.get((barber_id, day)))
+                    if schedule and schedule.starts:
+                        days[day] = schedule
+                loaded[(barber_id, monday)] = ExpandedWeek(days, version)
+                self._store(barber_id, monday, loaded[(barber_id, monday)])
+        return loaded
+
+    def _store(self, barber_id: int, monday: date, week: ExpandedWeek):
+        if len(self._weeks) >= MAX_ENTRIES:
+            now = monotonic_time.monotonic()
+            self._weeks = {key: value for key, value in self._weeks.items() if now - value.loaded_at <= self.ttl}
+        self._weeks[(barber_id, monday)] = week
+
+
+def week_query(barber_ids: list[int], start: date, end: date):
+    """Templates, exceptions and one-off bitmaps of the barbers for the days from `start` until `end`."""
+    return union_all(
+        select(
+            literal('template').label('kind'), ScheduleTemplate.barber_id, cast(null(), Date).label('day'),
+            ScheduleTemplate.weekday, ScheduleTemplate.start_time, ScheduleTemplate.end_time,
+            ScheduleTemplate.slot_minutes, cast(null(), Text).label('slots')
+        ).filter(
+            ScheduleTemplate.barber_id.in_(barber_ids)
+        ),
+        select(
+            literal('exception'), ScheduleException.barber_id, ScheduleException.day, null(),
+            ScheduleException.start_time, ScheduleException.end_time, ScheduleException.slot_minutes, null()
+        ).filter(
+            ScheduleException.barber_id.in_(barber_ids),
+            ScheduleException.day >= start,
+            ScheduleException.day < end
+        ),
+        select(
+            literal('one_off'), BarberSchedule.barber_id, BarberSchedule.day, null(), cast(null(), Time),
+            cast(null(), Time), null(), cast(BarberSchedule.slots, Text)
+        ).filter(
+            BarberSchedule.barber_id.in_(barber_ids),
+            BarberSchedule.day >= start,
+            BarberSchedule.day < end
+        )
+    )
+
+
+def taken_query(barber_ids: list[int], start: date, days=1):
+    """(barber_id, start, end) of everything that takes the barbers' time in the window, in no order.
+
+    Time is taken by an appointment or by a live hold of a chat that is still booking it.
+    Appointments that began up to MAX_SERVICE_MINUTES before the window may still run into it.
+    """
+    window_start = datetime.combine(start, time.min)
+    window_end = window_start + timedelta(days=days)
+    earliest = window_start - timedelta(minutes=MAX_SERVICE_MINUTES)
+    return union_all(
+        select(Appointment.barber_id, Appointment.time, Appointment.end_time).filter(
+            Appointment.barber_id.in_(barber_ids),
+            Appointment.time >= earliest,
+            Appointment.time < window_end,
+            Appointment.end_time > window_start
+        ),
+        select(SlotHold.barber_id, SlotHold.time, SlotHold.end_time).filter(
+            SlotHold.barber_id.in_(barber_ids),
+            SlotHold.time >= earliest,
+            SlotHold.time < window_end,
+            SlotHold.end_time > window_start,
+            SlotHold.expires_at > datetime.now()
+        )
+    )
+
+
+async def get_calendar(session: AsyncSession, barber_id: int, start: date, days=CALENDAR_DAYS,
+                       duration=SLOT_MINUTES) -> dict[date, int]:
+    """Count of the starts with room for `duration` for every day of the window that has a schedule."""
+    scheduled = (await week_schedules.days(session, [barber_id], start, start + timedelta(days=days)))[barber_id]
+    if not scheduled:
+        return {}
+    taken = [(begin, end) for _, begin, end in await session.execute(taken_query([barber_id], start, days))]
+    calendar = {}
+    for day, schedule in sorted(scheduled.items()):
+        day_start = datetime.combine(day, time.min)
+        overlapping = [(begin, end) for begin, end in taken if begin < day_start + timedelta(days=1) and end > day_start]
+        calendar[day] = len(DaySlots(schedule, taken_intervals(overlapping, day)).bookable(duration))
+    return calendar
+
+
+week_schedules = WeekSchedules()
+slot_index = SlotIndex()
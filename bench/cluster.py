@@ -0,0 +1,159 @@
+"""Drives `python -m cluster front --spawn N` with a burst of synthetic updates for several N.
+
+A fake Bot API server hands out the updates through getUpdates: every chat sends /start,
+'Соч олдириш 💇' and a salon name, each answered with one message. The run ends when all
+replies arrived; the report shows updates/s and the chats whose replies came out of order
+or didn't match the booking flow (a broken FSM sequence), which must be none.
+Needs a throwaway database whose name contains "bench". Scaling with N needs as many cores.
+
+    DB_URL=postgres:1@localhost:5449/hair_bot_bench python -m bench.cluster --workers 1 2 4 --chats 500
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import time
+from collections import defaultdict
+from datetime import date
+from urllib.parse import urlsplit
+
+os.environ.setdefault('DB_URL', 'postgres:1@localhost:5449/hair_bot_bench')
+os.environ.setdefault('BOT_API_URL', 'http://127.0.0.1:8089')
+os.environ.setdefault('BOT_TOKEN', '42:BENCH')
+os.environ.setdefault('ADMIN_ID', '0')
+# The fake server has no flood limits, the bench measures the handlers
+os.environ.setdefault('BOT_GLOBAL_RATE', '100000')
+
+from aiohttp import web
+from sqlalchemy import text
+
+from migrations import upgrade_schema
+from models import async_engine, DB_URL, rebuild_schedules
+
+SEED_SQL = """
+TRUNCATE outbox, slot_holds, appointments, barber_availabilities, barber_services, barbers, services, salons, users, fsm_states RESTART IDENTITY CASCADE;
+INSERT INTO salons (name, phone, latitude, longtitude) VALUES ('Salon 1', '', 41.3, 69.2);
+INSERT INTO barbers (name, salon_id, user_id) VALUES ('Barber 1', 1, 1000001);
+INSERT INTO services (salon_id, name, price) VALUES (1, 'Service 1', 50000);
+INSERT INTO barber_availabilities (barber_id, available_date, free_time)
+SELECT 1, :day, make_time(h, m, 0) FROM generate_series(0, 23) h, generate_series(0, 30, 30) m;
+"""
+FLOW = ['/start', 'Соч олдириш 💇', 'Salon 1']
+EXPECTED = ['Ассалому алайкум', 'Сартарошхона танланг', 'Сартарош танланг']  # Start of each reply
+
+
+class FakeBotAPI:
+    def __init__(self, chats: int):
+        self.updates = []
+        for step, message in enumerate(FLOW):
+            for chat in range(chats):
+                chat_id = 3_000_000 + chat
+                self.updates.append({
+                    'update_id': len(self.updates) + 1,
+                    'message': {
+                        'message_id': step + 1, 'date': int(time.time()), 'text': message,
+                        'chat': {'id': chat_id, 'type': 'private'},
+                        'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User {chat}'},
+                        **({'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]} if message == '/start' else {})
+                    }
+                })
+        self.replies: dict[int, list[str]] = defaultdict(list)
+        self.sent = 0
+        self.first_fetch: float | None = None
+        self.done = asyncio.Event()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        form = await request.post()
+        if method == 'getupdates':
+            offset = int(form.get('offset') or 0)
+            batch = [update for update in self.updates if update['update_id'] >= offset][:100]
+            if batch and self.first_fetch is None:
+                self.first_fetch = time.perf_counter()
+            if not batch:
+                await asyncio.sleep(1)
+            return web.json_response({'ok': True, 'result': batch})
+        if method == 'getme':
+            return web.json_response({'ok': True, 'result': {'id': 42, 'is_bot': True, 'first_name': 'Bench'}})
+        if method != 'sendmessage':
+            return web.json_response({'ok': True, 'result': True})
+
+        chat_id = int(form['chat_id'])
+        self.replies[chat_id].append(form['text'])
+        self.sent += 1
+        if self.sent == len(self.updates):
+            self.done.set()
+        return web.json_response({'ok': True, 'result': {
+            'message_id': self.sent, 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'}, 'text': form['text']
+        }})
+
+    def broken_chats(self) -> int:
+        return sum(
+            len(replies) != len(EXPECTED) or not all(map(str.startswith, replies, EXPECTED))
+            for replies in self.replies.values()
+        )
+
+
+async def seed():
+    async with async_engine.begin() as connection:
+        # asyncpg prepares statements one at a time
+        for statement in filter(str.strip, SEED_SQL.split(';')):
+            params = {'day': date.today()}
+            await connection.execute(text(statement), {k: v for k, v in params.items() if f':{k}' in statement})
+        # Plain inserts skip the mapper events that keep the schedule bitmaps in sync
+        await connection.execute(rebuild_schedules())
+
+
+async def run_once(workers: int, args) -> tuple[float, int, int]:
+    await seed()
+    server = FakeBotAPI(args.chats)
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', urlsplit(os.environ['BOT_API_URL']).port).start()
+
+    front = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'cluster', 'front', '--spawn', str(workers), '--base-port', str(args.base_port),
+        stdout=asyncio.subprocess.DEVNULL
+    )
+    try:
+        await asyncio.wait_for(server.done.wait(), args.timeout)
+        elapsed = time.perf_counter() - server.first_fetch
+    except asyncio.TimeoutError:
+        elapsed = float('nan')
+    front.send_signal(signal.SIGINT)
+    await front.wait()
+    await runner.cleanup()
+    return elapsed, server.sent, server.broken_chats()
+
+
+async def run(args) -> bool:
+    await asyncio.to_thread(upgrade_schema)
+    ok = True
+    print(f'chats: {args.chats}, updates: {args.chats * len(FLOW)}')
+    for workers in args.workers:
+        elapsed, sent, broken = await run_once(workers, args)
+        ok = ok and sent == args.chats * len(FLOW) and not broken
+        print(f'workers: {workers}, replies: {sent}, elapsed: {elapsed:.2f} s, '
+              f'{sent / elapsed:.0f} updates/s, broken chats: {broken}')
+    await async_engine.dispose()
+    return ok
+
+
+def run_main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='worker counts to compare')
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--base-port', type=int, default=8101)
+    parser.add_argument('--timeout', type=float, default=120, help='seconds to wait for all replies')
+    args = parser.parse_args()
+    if 'bench' not in DB_URL.rsplit('/', 1)[-1]:
+        sys.exit(f'Refusing to truncate {DB_URL}: the database name must contain "bench"')
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == '__main__':
+    run_main()
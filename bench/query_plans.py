@@ -0,0 +1,159 @@
+"""Checks that the booking hot queries use index scans on a database with ~1M appointments.
+
+Fills a throwaway database (DB_URL must point to a database whose name contains "bench")
+with generated rows, then prints EXPLAIN ANALYZE summaries of the queries the bot runs
+and exits with status 1 if any of them falls back to a sequential scan of a big table.
+
+    DB_URL=postgres:1@localhost:5449/hair_bot_bench python -m bench.query_plans
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import date, datetime, time, timedelta
+
+os.environ.setdefault('DB_URL', 'postgres:1@localhost:5449/hair_bot_bench')
+
+from sqlalchemy import text, select, exists
+from sqlalchemy.dialects import postgresql
+
+from availability import taken_query, week_query, week_start, CALENDAR_DAYS
+from migrations import upgrade_schema
+from booking import slot_exists, overlapping
+from models import engine, DB_URL, User, Barber, BarberService, Service, Appointment, rebuild_schedules
+
+BIG_TABLES = {'appointments', 'barber_availabilities', 'barber_schedules', 'users', 'barbers', 'barber_services',
+              'slot_holds', 'schedule_templates', 'schedule_exceptions'}
+
+SEED_SQL = """
+TRUNCATE slot_holds, appointments, barber_availabilities, barber_services, barbers, services, salons, users RESTART IDENTITY CASCADE;
+
+INSERT INTO salons (name, phone, latitude, longtitude)
+SELECT 'Salon ' || g, '', 41.3, 69.2 FROM generate_series(1, :salons) g;
+
+INSERT INTO barbers (name, salon_id, user_id)
+SELECT 'Barber ' || g, (g - 1) / :barbers_per_salon + 1, 1000000 + g
+FROM generate_series(1, :salons * :barbers_per_salon) g;
+
+INSERT INTO services (salon_id, name, price, duration_minutes)
+SELECT s, 'Service ' || k, 50000, 30 * k FROM generate_series(1, :salons) s, generate_series(1, 5) k;
+
+INSERT INTO barber_services (barber_id, service_id)
+SELECT b.id, (b.salon_id - 1) * 5 + k FROM barbers b, generate_series(1, 3) k;
+
+INSERT INTO users (user_id) SELECT 2000000 + g FROM generate_series(1, :users) g;
+
+-- One row per free slot: 8 slots a day over the next :days days
+INSERT INTO barber_availabilities (barber_id, available_date, free_time)
+SELECT b, current_date + d, make_time(10 + h, 0, 0)
+FROM generate_series(1, :salons * :barbers_per_salon) b, generate_series(0, :days - 1) d, generate_series(0, 7) h;
+
+-- Weekly templates, Monday to Saturday 10:00 to 18:00, and a day off every week
+INSERT INTO schedule_templates (barber_id, weekday, start_time, end_time, slot_minutes)
+SELECT b, w, '10:00', '18:00', 60 FROM generate_series(1, :salons * :barbers_per_salon) b, generate_series(0, 5) w;
+
+INSERT INTO schedule_exceptions (barber_id, day)
+SELECT b, current_date + d FROM generate_series(1, :salons * :barbers_per_salon) b, generate_series(b % 7, :days - 1, 7) d;
+
+-- Chats in the middle of a booking: a live hold on every other barber's first slot tomorrow
+INSERT INTO slot_holds (barber_id, time, end_time, chat_id, expires_at)
+SELECT b, current_date + 1 + make_interval(hours => 10), current_date + 1 + make_interval(hours => 11), 3000000 + b,
+       now() + interval '10 minutes'
+FROM generate_series(1, :salons * :barbers_per_salon, 2) b;
+
+-- Booking history reaching back from today, one hour-long slot after another
+INSERT INTO appointments (user_id, salon_id, barber_id, time, end_time, name, phone, service_id)
+SELECT 1 + (b * :appointments_per_barber + k) % :users, (b - 1) / :barbers_per_salon + 1, b,
+       current_date - (k / 8) + make_interval(hours => 10 + k % 8),
+       current_date - (k / 8) + make_interval(hours => 11 + k % 8), 'Client', '+998',
+       ((b - 1) / :barbers_per_salon) * 5 + 1
+FROM generate_series(1, :salons * :barbers_per_salon) b, generate_series(0, :appointments_per_barber - 1) k;
+"""
+
+
+def hot_queries(barber_id: int, salon_id: int):
+    today = date.today()
+    tomorrow = datetime.combine(today + timedelta(days=1), time(11))
+    salon_barbers = list(range((salon_id - 1) * 4 + 1, salon_id * 4 + 1))
+    return {
+        'taken slots of one barber (get_available_times)': taken_query([barber_id], today),
+        'taken slots of a salon (SlotIndex.get_salon)': taken_query(salon_barbers, today),
+        'taken slots of the calendar (get_calendar)': taken_query([barber_id], today, CALENDAR_DAYS),
+        'week of a salon (WeekSchedules)': week_query(salon_barbers, week_start(today), week_start(today) + timedelta(days=7)),
+        'slot check (booking.slot_exists)': select(slot_exists(barber_id, tomorrow, tomorrow + timedelta(minutes=90))),
+        'overlap check (booking.hold_slot)': select(
+            exists().where(overlapping(Appointment, barber_id, tomorrow, tomorrow + timedelta(minutes=90)))
+        ),
+        'user by telegram id': select(User).filter(User.user_id == 2000500),
+        'barbers of a salon': select(Barber).filter(Barber.salon_id == salon_id),
+        'barber by name': select(Barber).filter(Barber.name == f'Barber {barber_id}'),
+        'barber service menu (Catalog.barber_services)': select(
+            Service.id, Service.name, Service.price, Service.duration_minutes
+        ).join(
+            BarberService, BarberService.service_id == Service.id).filter(BarberService.barber_id == barber_id),
+    }
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def explain(connection, query):
+    # Not pyformat: text() would escape its % again
+    sql = str(query.compile(dialect=postgresql.dialect(paramstyle='named'), compile_kwargs={'literal_binds': True}))
+    result = connection.execute(text(f'EXPLAIN (ANALYZE, FORMAT JSON) {sql}')).scalar()
+    result = result if isinstance(result, list) else json.loads(result)
+    return result[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--salons', type=int, default=500)
+    parser.add_argument('--barbers-per-salon', type=int, default=4)
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--appointments-per-barber', type=int, default=500)
+    parser.add_argument('--skip-seed', action='store_true', help='reuse the data of a previous run')
+    args = parser.parse_args()
+
+    if 'bench' not in DB_URL.rsplit('/', 1)[-1]:
+        sys.exit(f'Refusing to truncate {DB_URL}: the database name must contain "bench"')
+
+    upgrade_schema()
+    with engine.begin() as connection:
+        if not args.skip_seed:
+            print('Seeding...')
+            connection.execute(text(SEED_SQL), {
+                'salons': args.salons,
+                'barbers_per_salon': args.barbers_per_salon,
+                'users': args.users,
+                'days': args.days,
+                'appointments_per_barber': args.appointments_per_barber,
+            })
+            # Plain inserts skip the mapper events that keep the schedule bitmaps in sync
+            connection.execute(rebuild_schedules())
+            connection.execute(text('ANALYZE'))
+        appointments = connection.execute(text('SELECT count(*) FROM appointments')).scalar()
+        print(f'appointments: {appointments}')
+
+        failed = False
+        for name, query in hot_queries(barber_id=args.salons, salon_id=args.salons // 2).items():
+            result = explain(connection, query)
+            nodes = list(plan_nodes(result['Plan']))
+            seq_scans = sorted({node['Relation Name'] for node in nodes
+                                if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in BIG_TABLES})
+            scans = sorted({f"{node['Node Type']} on {node['Relation Name']}" for node in nodes
+                            if 'Relation Name' in node})
+            status = 'FAIL' if seq_scans else 'ok'
+            failed = failed or bool(seq_scans)
+            print(f"[{status}] {name}: {result['Execution Time']:.3f} ms")
+            for scan in scans:
+                print(f'        {scan}')
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Runs the bot's outgoing traffic against a fake Bot API server that enforces flood limits.
+
+The fake server answers sendMessage like Telegram and replies 429 with retry_after when
+the global (~30/s) or a chat's (1/s with small bursts) rate is exceeded. An ad to many
+chats (bulk) and users receiving bursts of replies (interactive) run at the same time
+through the Bot built by main.create_bot; the report shows the 429s the server had to
+send, errors that reached the callers and the latency of the interactive replies.
+Run once with and once without --no-limit to compare.
+
+    python -m bench.rate_limit --bulk-chats 600 --users 20
+"""
+import argparse
+import asyncio
+import os
+import time
+from urllib.parse import urlsplit
+
+os.environ.setdefault('BOT_API_URL', 'http://127.0.0.1:8089')
+os.environ.setdefault('BOT_TOKEN', '42:BENCH')
+os.environ.setdefault('ADMIN_ID', '0')
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError
+from aiohttp import web
+
+import main
+from ratelimit import bulk_traffic
+
+
+class Allowance:
+    """Non-blocking token bucket, the way the fake server accounts a limit."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class FakeBotAPI:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.global_allowance = Allowance(30, 30)
+        self.chats: dict[str, Allowance] = {}
+        self.sent = 0
+        self.flood_waits = 0
+        self.message_id = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        form = await request.post()
+        method = request.match_info['method'].lower()
+        if method != 'sendmessage':
+            return web.json_response({'ok': True, 'result': True})
+
+        chat_id = form['chat_id']
+        chat = self.chats.setdefault(chat_id, Allowance(1, 5))
+        if not chat.take() or not self.global_allowance.take():
+            self.flood_waits += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}
+            }, status=429)
+
+        self.sent += 1
+        self.message_id += 1
+        return web.json_response({'ok': True, 'result': {
+            'message_id': self.message_id, 'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'}, 'text': form.get('text')
+        }})
+
+    async def start(self, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        return runner
+
+
+async def send(bot: Bot, chat_id: int, errors: list) -> float:
+    began = time.perf_counter()
+    try:
+        await bot.send_message(chat_id, 'bench')
+    except TelegramAPIError as e:
+        errors.append(e)
+    return time.perf_counter() - began
+
+
+async def ad(bot: Bot, chats: int, concurrency: int, errors: list) -> float:
+    bulk_traffic.set(True)
+    semaphore = asyncio.Semaphore(concurrency)
+    began = time.perf_counter()
+
+    async def one(chat_id):
+        async with semaphore:
+            await send(bot, chat_id, errors)
+
+    await asyncio.gather(*(one(100_000 + index) for index in range(chats)))
+    return time.perf_counter() - began
+
+
+async def user(bot: Bot, chat_id: int, rounds: int, errors: list) -> list[float]:
+    # A handler typically answers with two or three messages, then the user reads and taps again
+    latencies = []
+    for _ in range(rounds):
+        latencies += await asyncio.gather(*(send(bot, chat_id, errors) for _ in range(2)))
+        await asyncio.sleep(1.5)
+    return latencies
+
+
+async def run(args):
+    server = FakeBotAPI(args.latency)
+    runner = await server.start(urlsplit(main.BOT_API_URL).port)
+
+    if args.no_limit:
+        bot = Bot(main.TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(main.BOT_API_URL)))
+    else:
+        bot = main.create_bot()
+
+    bulk_errors, user_errors = [], []
+    bulk_time, *user_latencies = await asyncio.gather(
+        ad(bot, args.bulk_chats, args.concurrency, bulk_errors),
+        *(user(bot, index + 1, args.rounds, user_errors) for index in range(args.users))
+    )
+    await bot.session.close()
+    await runner.cleanup()
+
+    latencies = sorted(latency for latencies in user_latencies for latency in latencies)
+    print(f"rate limiter: {'off' if args.no_limit else 'on'}")
+    print(f'delivered: {server.sent}, 429s sent by the server: {server.flood_waits}')
+    print(f'ad: {args.bulk_chats} chats in {bulk_time:.2f} s ({args.bulk_chats / bulk_time:.1f} msg/s), '
+          f'errors: {len(bulk_errors)}')
+    print(f'replies: {len(latencies)}, errors: {len(user_errors)}, latency p50: {latencies[len(latencies) // 2] * 1000:.0f} ms, '
+          f'p95: {latencies[int(len(latencies) * 0.95)] * 1000:.0f} ms, max: {latencies[-1] * 1000:.0f} ms')
+
+
+def run_main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bulk-chats', type=int, default=600)
+    parser.add_argument('--concurrency', type=int, default=50, help='parallel sends of the ad')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=5, help='reply bursts per user')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the fake server takes per call')
+    parser.add_argument('--no-limit', action='store_true', help='plain Bot without the middlewares, as a baseline')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,268 @@
+"""Replays whole booking conversations through handlers.dp, offline.
+
+Every synthetic chat goes /start → 'Соч олдириш 💇' → salon → barber → service → date →
+time → name → phone → confirm, each chat on its own free slot, many chats at once. The Bot
+runs on a session that records the API calls instead of sending them, the database is the
+real one, seeded here. Reports updates/s and, per handler, the p50/p95/p99 latency and the
+SQL statements per update. Exits with 1 when not every chat got its appointment, or, with
+--compare, when a handler got slower than the tolerance allows or runs more statements.
+Needs a throwaway database whose name contains "bench".
+
+    DB_URL=postgres:1@localhost:5449/hair_bot_bench python -m bench.replay --chats 500 --save base.json
+    DB_URL=postgres:1@localhost:5449/hair_bot_bench python -m bench.replay --chats 500 --compare base.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict
+
+os.environ.setdefault('DB_URL', 'postgres:1@localhost:5449/hair_bot_bench')
+os.environ.setdefault('BOT_TOKEN', '42:BENCH')
+os.environ.setdefault('ADMIN_ID', '0')
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update, Message, CallbackQuery, Chat, User as TelegramUser, TelegramObject
+from sqlalchemy import text, func, select
+
+import metrics
+from handlers import dp
+from migrations import upgrade_schema
+from models import async_session, async_engine, DB_URL, Appointment
+
+SLOTS_PER_DAY = 24  # 08:00 to 19:30 every 30 minutes, every barber's weekly template
+FIRST_SLOT = timedelta(hours=8)
+SLOT_STEP = timedelta(minutes=30)
+QUERY_TOLERANCE = 0.5  # statements per update; cache hits vary a little between runs, a new query doesn't
+
+SEED_SQL = """
+TRUNCATE outbox, slot_holds, appointments, barber_availabilities, barber_services, barbers, services, salons, users, fsm_states RESTART IDENTITY CASCADE;
+INSERT INTO salons (name, phone, latitude, longtitude)
+SELECT 'Salon ' || s, '+998000000000', 41.3, 69.2 FROM generate_series(1, :salons) s;
+INSERT INTO barbers (name, salon_id, user_id)
+SELECT 'Barber ' || s || '-' || b, s, 1000000 + (s - 1) * :barbers + b
+FROM generate_series(1, :salons) s, generate_series(1, :barbers) b ORDER BY s, b;
+INSERT INTO services (salon_id, name, price)
+SELECT s, v.name, v.price FROM generate_series(1, :salons) s, (VALUES ('Cut', 50000), ('Shave', 30000)) v(name, price)
+ORDER BY s;
+INSERT INTO barber_services (barber_id, service_id)
+SELECT b.id, s.id FROM barbers b JOIN services s ON s.salon_id = b.salon_id ORDER BY b.id, s.id;
+INSERT INTO schedule_templates (barber_id, weekday, start_time, end_time, slot_minutes)
+SELECT b.id, w, '08:00', '20:00', 30 FROM barbers b, generate_series(0, 6) w;
+"""
+
+
+class RecordingSession(BaseSession):
+    """Answers Bot API calls locally and counts them by method."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls: Counter[str] = Counter()
+        self.message_id = 0
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout=None) -> Any:
+        self.calls[method.__api_method__] += 1
+        if method.__api_method__.startswith('send'):
+            self.message_id += 1
+            return Message(
+                message_id=self.message_id, date=datetime.now(), chat=Chat(id=method.chat_id, type='private'),
+                text=getattr(method, 'text', None)
+            )
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+_captured: ContextVar[list] = ContextVar('captured')
+
+
+class CaptureMiddleware(BaseMiddleware):
+    """Hands the UpdateStats of MetricsMiddleware to the replay, which reads them once the update is done."""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        _captured.get().append(metrics.current_update.get())
+        return await handler(event, data)
+
+
+class Conversation:
+    """The updates of one chat booking `barber_id` at `moment`."""
+
+    def __init__(self, chat_id: int, salons: int, barbers: int, barber_id: int, moment: datetime):
+        self.chat_id = chat_id
+        salon = (barber_id - 1) // barbers + 1
+        self.steps = [
+            '/start', 'Соч олдириш 💇', f'Salon {salon}', f'Barber {salon}-{(barber_id - 1) % barbers + 1}', 'Cut',
+            moment.strftime('%Y-%m-%d'), moment.strftime('%H:%M'), f'Client {chat_id}', '+998901234567', None
+        ]
+
+    def updates(self, first_update_id: int):
+        user = TelegramUser(id=self.chat_id, is_bot=False, first_name=f'Client {self.chat_id}')
+        chat = Chat(id=self.chat_id, type='private')
+        for index, step in enumerate(self.steps):
+            update_id = first_update_id + index
+            message = Message(message_id=index + 1, date=datetime.now(), chat=chat, from_user=user, text=step)
+            if step is None:
+                yield Update(update_id=update_id, callback_query=CallbackQuery(
+                    id=str(update_id), from_user=user, chat_instance=str(self.chat_id), data='confirm_booking',
+                    message=message.model_copy(update={'text': 'confirm'})
+                ))
+            else:
+                yield Update(update_id=update_id, message=message)
+
+
+async def seed(args):
+    params = {'salons': args.salons, 'barbers': args.barbers}
+    async with async_engine.begin() as connection:
+        # asyncpg prepares statements one at a time
+        for statement in filter(str.strip, SEED_SQL.split(';')):
+            await connection.execute(text(statement), {k: v for k, v in params.items() if f':{k}' in statement})
+
+
+def conversations(args) -> list[Conversation]:
+    total_barbers = args.salons * args.barbers
+    result = []
+    for index in range(args.chats):
+        barber_id = index % total_barbers + 1
+        slot = index // total_barbers
+        day = date.today() + timedelta(days=1 + slot // SLOTS_PER_DAY)
+        moment = datetime.combine(day, datetime.min.time()) + FIRST_SLOT + SLOT_STEP * (slot % SLOTS_PER_DAY)
+        result.append(Conversation(5_000_000 + index, args.salons, args.barbers, barber_id, moment))
+    return result
+
+
+async def replay(bot: Bot, conversation: Conversation, first_update_id: int, samples: dict):
+    for update in conversation.updates(first_update_id):
+        captured = []
+        _captured.set(captured)
+        started = time.perf_counter()
+        result = await dp.feed_update(bot, update)
+        if isinstance(result, TelegramMethod):
+            # Sent right away, as the UpdateScheduler does
+            await bot(result)
+        elapsed = time.perf_counter() - started
+        stats = captured[0] if captured else None
+        samples[stats.handler if stats else 'unhandled'].append((elapsed, stats.queries if stats else 0))
+
+
+def percentile(values: list[float], q: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def summarize(samples: dict, elapsed: float, updates: int, config: dict) -> dict:
+    handlers = {}
+    for handler, rows in samples.items():
+        latencies = sorted(latency for latency, _ in rows)
+        handlers[handler] = {
+            'count': len(rows),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'queries': sum(queries for _, queries in rows) / len(rows)
+        }
+    return {'config': config, 'updates_per_second': updates / elapsed, 'handlers': handlers}
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    if baseline['config'] != result['config']:
+        print(f"WARNING the baseline ran with {baseline['config']}, latencies are not comparable")
+    regressions = []
+    for handler, now in result['handlers'].items():
+        before = baseline['handlers'].get(handler)
+        if before is None:
+            continue
+        if now['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append(f"{handler}: p95 {before['p95'] * 1000:.1f} → {now['p95'] * 1000:.1f} ms")
+        # Statement counts don't depend on the machine
+        if now['queries'] > before['queries'] + QUERY_TOLERANCE:
+            regressions.append(f"{handler}: {before['queries']:.2f} → {now['queries']:.2f} queries per update")
+    return regressions
+
+
+async def run(args) -> bool:
+    await asyncio.to_thread(upgrade_schema)
+    await seed(args)
+    for event_name, observer in dp.observers.items():
+        if event_name not in ('update', 'error'):
+            observer.middleware(CaptureMiddleware())
+
+    recording = RecordingSession()
+    bot = Bot(os.environ['BOT_TOKEN'], session=recording)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+
+    chats = conversations(args)
+    samples = defaultdict(list)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(index: int, conversation: Conversation):
+        async with semaphore:
+            await replay(bot, conversation, index * len(conversation.steps) + 1, samples)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(index, conversation) for index, conversation in enumerate(chats)))
+    elapsed = time.perf_counter() - started
+
+    await dp.emit_shutdown(bot=bot, dispatcher=dp)
+    async with async_session() as session:
+        booked = await session.scalar(select(func.count()).select_from(Appointment))
+    await async_engine.dispose()
+
+    updates = sum(map(len, samples.values()))
+    config = {key: getattr(args, key) for key in ('chats', 'concurrency', 'salons', 'barbers', 'days')}
+    result = summarize(samples, elapsed, updates, config)
+    print(f'chats: {args.chats}, updates: {updates}, concurrency: {args.concurrency}, elapsed: {elapsed:.2f} s, '
+          f'{result["updates_per_second"]:.0f} updates/s')
+    print(f'appointments: {booked}, api calls: {dict(recording.calls)}')
+    print(f'{"handler":<24}{"count":>7}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"queries":>9}')
+    for handler, row in sorted(result['handlers'].items(), key=lambda item: -item[1]['p95']):
+        print(f'{handler:<24}{row["count"]:>7}{row["p50"] * 1000:>9.1f}{row["p95"] * 1000:>9.1f}'
+              f'{row["p99"] * 1000:>9.1f}{row["queries"]:>9.2f}')
+
+    ok = booked == args.chats
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(result, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        ok = ok and not regressions
+    return ok
+
+
+def run_main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=32, help='chats in flight, like UPDATE_WORKERS')
+    parser.add_argument('--salons', type=int, default=5)
+    parser.add_argument('--barbers', type=int, default=4, help='per salon')
+    parser.add_argument('--days', type=int, default=14, help='days after today the bookings may spread over')
+    parser.add_argument('--save', help='write the results as JSON, a baseline for --compare')
+    parser.add_argument('--compare', help='baseline JSON to check the results against')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed p95 growth over the baseline')
+    args = parser.parse_args()
+    if 'bench' not in DB_URL.rsplit('/', 1)[-1]:
+        sys.exit(f'Refusing to truncate {DB_URL}: the database name must contain "bench"')
+    if args.chats > args.salons * args.barbers * SLOTS_PER_DAY * args.days:
+        sys.exit('Not enough slots for one per chat, add --days, --salons or --barbers')
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == '__main__':
+    run_main()
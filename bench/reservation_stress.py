@@ -0,0 +1,101 @@
+"""Fires many simultaneous booking confirmations at the same slots.
+
+Every client runs booking.reserve_slot in its own session and transaction, the way
+confirm_booking does, all released at once. Exactly one client per slot must win, and the
+appointments table must end up with exactly one row per slot and the outbox with the
+winners' notifications only; anything else exits with 1.
+Needs a throwaway database whose name contains "bench".
+
+    DB_URL=postgres:1@localhost:5449/hair_bot_bench python -m bench.reservation_stress --clients 500
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+os.environ.setdefault('DB_URL', 'postgres:1@localhost:5449/hair_bot_bench')
+
+from sqlalchemy import text, func, select
+
+from booking import reserve_slot
+from migrations import upgrade_schema
+from models import async_session, async_engine, DB_URL, Appointment, OutboxMessage, rebuild_schedules
+
+SEED_SQL = """
+TRUNCATE outbox, slot_holds, appointments, barber_availabilities, barber_services, barbers, services, salons, users RESTART IDENTITY CASCADE;
+INSERT INTO salons (name, phone, latitude, longtitude) VALUES ('Salon 1', '', 41.3, 69.2);
+INSERT INTO barbers (name, salon_id, user_id) VALUES ('Barber 1', 1, 1000001);
+INSERT INTO services (salon_id, name, price) VALUES (1, 'Service 1', 50000);
+INSERT INTO users (user_id) SELECT 2000000 + g FROM generate_series(1, :clients) g;
+INSERT INTO barber_availabilities (barber_id, available_date, free_time)
+SELECT 1, :day, make_time(10 + h, 0, 0) FROM generate_series(0, :slots - 1) h;
+"""
+
+
+async def client(start: asyncio.Event, user_pk: int, moment: datetime) -> tuple[bool, float]:
+    await start.wait()
+    began = time.perf_counter()
+    async with async_session() as session:
+        appointment_id = await reserve_slot(
+            session, chat_id=2000000 + user_pk, salon_id=1, barber_id=1, service_id=1, time=moment,
+            name='Client', phone='+998', barber_message='New booking', customer_messages=['Booked']
+        )
+        await session.commit()
+    return appointment_id is not None, time.perf_counter() - began
+
+
+async def run(args) -> bool:
+    day = date.today() + timedelta(days=1)
+    async with async_engine.begin() as connection:
+        # asyncpg prepares statements one at a time
+        for statement in filter(str.strip, SEED_SQL.split(';')):
+            params = {'clients': args.clients, 'slots': args.slots, 'day': day}
+            await connection.execute(text(statement), {k: v for k, v in params.items() if f':{k}' in statement})
+        # Plain inserts skip the mapper events that keep the schedule bitmaps in sync
+        await connection.execute(rebuild_schedules())
+
+    start = asyncio.Event()
+    slots = [datetime.combine(day, datetime.min.time()) + timedelta(hours=10 + h) for h in range(args.slots)]
+    tasks = [asyncio.create_task(client(start, user_pk, slots[user_pk % args.slots]))
+             for user_pk in range(1, args.clients + 1)]
+    await asyncio.sleep(0)
+    began = time.perf_counter()
+    start.set()
+    results = await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - began
+
+    async with async_session() as session:
+        booked = await session.scalar(select(func.count()).select_from(Appointment))
+        queued = await session.scalar(select(func.count()).select_from(OutboxMessage))
+    await async_engine.dispose()
+
+    winners = sum(won for won, _ in results)
+    latencies = sorted(latency for _, latency in results)
+    print(f'clients: {args.clients}, slots: {args.slots}, elapsed: {elapsed:.3f} s')
+    print(f'winners: {winners}, rejected: {args.clients - winners}, appointments in db: {booked}, '
+          f'notifications queued: {queued}')
+    print(f'latency p50: {latencies[len(latencies) // 2] * 1000:.1f} ms, '
+          f'p99: {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms')
+    # One message to the barber and one to the customer per booking, none for the losers
+    return winners == booked == min(args.slots, args.clients) and queued == 2 * booked
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=300)
+    parser.add_argument('--slots', type=int, default=1, help='slots the clients are spread over')
+    args = parser.parse_args()
+
+    if 'bench' not in DB_URL.rsplit('/', 1)[-1]:
+        sys.exit(f'Refusing to truncate {DB_URL}: the database name must contain "bench"')
+
+    upgrade_schema()
+    ok = asyncio.run(run(args))
+    print('ok' if ok else 'FAIL: double booking or lost reservation')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
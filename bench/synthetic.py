@@ -0,0 +1,272 @@
+"""Fills a throwaway database with a realistic, reproducible volume of salons, barbers and bookings.
+
+Salons get a varying number of barbers and their own service menus; every barber works his
+own weekdays and hours in 30 or 60 minute slots, kept as weekly templates with the odd day
+off, from --history-days back to --days ahead. Past slots are mostly booked, the near future
+partly and the far future hardly; services take 15 to 90 minutes and their bookings never overlap. The same --seed always produces the same rows, dated
+relative to today. Rows go in with COPY, straight from generators.
+With --availability-rows every slot is also written as a BarberAvailability row, the way
+schedules were kept before the templates.
+Needs a database whose name contains "bench"; everything in it is replaced.
+
+    DB_URL=postgres:1@localhost:5449/hair_bot_bench python -m bench.synthetic --salons 500 --seed 1
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, time as day_time, timedelta
+from typing import NamedTuple
+
+os.environ.setdefault('DB_URL', 'postgres:1@localhost:5449/hair_bot_bench')
+
+import asyncpg
+from sqlalchemy import text
+
+from migrations import upgrade_schema
+from models import async_engine, DB_URL, User, Salon, Service, Barber, BarberService, BarberAvailability, \
+    BarberSchedule, Appointment, CatalogVersion, ScheduleTemplate, ScheduleException, SLOT_MINUTES, DAY_SLOTS
+
+SALON_NAMES = ['Барбершоп', 'Сартарошхона', 'Гўзаллик', 'Style', 'Classic', 'Usta', 'Barber House', 'Soch Studio']
+FIRST_NAMES = ['Ali', 'Vali', 'Bobur', 'Jasur', 'Sardor', 'Aziz', 'Otabek', 'Sherzod', 'Rustam', 'Javlon', 'Doston',
+               'Farrux', 'Ulugbek', 'Anvar', 'Shoxrux', 'Temur']
+SERVICES = [('Соч олдириш', 50000, 30), ('Соқол олиш', 30000, 30), ('Соч ва соқол', 70000, 60),
+            ('Болалар сочи', 35000, 30), ('Соч бўяш', 120000, 90), ('Укладка', 40000, 45), ('Юз парвариши', 90000, 60),
+            ('Қош тўғрилаш', 20000, 15)]
+TASHKENT = (41.31, 69.28)
+DAY_OFF_CHANCE = 0.03  # Working days a barber takes off anyway
+OVERLAP_CONSTRAINT = 'ex_appointments_barber_overlap'
+
+
+class Schedule(NamedTuple):
+    weekdays: frozenset[int]
+    start: int  # minute of the day
+    end: int
+    step: int  # minutes
+    days_off: frozenset[date]  # Exceptions to the weekdays
+
+
+class BarberRow(NamedTuple):
+    id: int
+    salon_id: int
+    services: tuple[int, ...]
+
+
+def barber_schedule(seed: int, barber_id: int, days: list[date]) -> Schedule:
+    # Its own generator, so the schedule and appointment passes see the same slots
+    rng = random.Random(f'{seed}/schedule/{barber_id}')
+    weekly_off = rng.sample(range(7), rng.choice([1, 1, 2]))
+    start = rng.choice([8, 9, 9, 10, 10, 11]) * 60
+    end = rng.choice([17, 18, 19, 20, 21]) * 60
+    step = rng.choice([30, 30, 60])
+    days_off = frozenset(day for day in days if day.weekday() not in weekly_off and rng.random() < DAY_OFF_CHANCE)
+    return Schedule(frozenset(set(range(7)) - set(weekly_off)), start, end, step, days_off)
+
+
+def works_on(schedule: Schedule, day: date) -> bool:
+    return day.weekday() in schedule.weekdays and day not in schedule.days_off
+
+
+def slots(schedule: Schedule, days: list[date]):
+    for day in days:
+        if works_on(schedule, day):
+            midnight = datetime.combine(day, datetime.min.time())
+            for minute in range(schedule.start, schedule.end, schedule.step):
+                yield midnight + timedelta(minutes=minute)
+
+
+class Generator:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        today = date.today()
+        self.days = [today + timedelta(days=offset) for offset in range(-args.history_days, args.days)]
+        self.today = datetime.combine(today, datetime.min.time())
+        self.barbers: list[BarberRow] = []
+        self.services: list[tuple] = []
+
+    def users(self):
+        for index in range(1, self.args.users + 1):
+            yield (index, 10_000_000 + index, f'user{index}', f'{self.rng.choice(FIRST_NAMES)}',
+                   f'+99890{self.rng.randrange(10 ** 7):07d}', False)
+
+    def salons(self):
+        for salon_id in range(1, self.args.salons + 1):
+            latitude = TASHKENT[0] + self.rng.uniform(-0.15, 0.15)
+            longitude = TASHKENT[1] + self.rng.uniform(-0.15, 0.15)
+            yield (salon_id, f'{self.rng.choice(SALON_NAMES)} {salon_id}', f'+99871{self.rng.randrange(10 ** 7):07d}',
+                   latitude, longitude)
+
+    def plan(self):
+        """Menus and staff of every salon, small enough to keep in memory."""
+        barber_id = 0
+        for salon_id in range(1, self.args.salons + 1):
+            menu = []
+            for name, price, duration in self.rng.sample(SERVICES, self.rng.randint(3, len(SERVICES))):
+                self.services.append((len(self.services) + 1, salon_id, name, price * self.rng.choice([1, 1, 1.2, 1.5]),
+                                      duration))
+                menu.append(len(self.services))
+            average = self.args.barbers_per_salon
+            for _ in range(max(1, round(self.rng.gauss(average, average / 3)))):
+                barber_id += 1
+                offered = self.rng.sample(menu, self.rng.randint(max(1, len(menu) // 2), len(menu)))
+                self.barbers.append(BarberRow(barber_id, salon_id, tuple(sorted(offered))))
+
+    def barber_rows(self):
+        for barber in self.barbers:
+            yield barber.id, f'{self.rng.choice(FIRST_NAMES)} {barber.id}', barber.salon_id, 1_000_000_000 + barber.id
+
+    def barber_services(self):
+        row_id = 0
+        for barber in self.barbers:
+            for service_id in barber.services:
+                row_id += 1
+                yield row_id, barber.id, service_id
+
+    def templates(self):
+        row_id = 0
+        for barber in self.barbers:
+            schedule = barber_schedule(self.args.seed, barber.id, self.days)
+            for weekday in sorted(schedule.weekdays):
+                row_id += 1
+                yield (row_id, barber.id, weekday, day_time(schedule.start // 60), day_time(schedule.end // 60),
+                       schedule.step)
+
+    def exceptions(self):
+        row_id = 0
+        for barber in self.barbers:
+            for day in sorted(barber_schedule(self.args.seed, barber.id, self.days).days_off):
+                row_id += 1
+                yield row_id, barber.id, day, 30
+
+    def availabilities(self):
+        if not self.args.availability_rows:
+            return
+        row_id = 0
+        for barber in self.barbers:
+            for moment in slots(barber_schedule(self.args.seed, barber.id, self.days), self.days):
+                row_id += 1
+                yield row_id, barber.id, moment.replace(hour=0, minute=0), moment.time()
+
+    def schedules(self):
+        # What the mapper events on BarberAvailability would have written, COPY skips them
+        if not self.args.availability_rows:
+            return
+        for barber in self.barbers:
+            schedule = barber_schedule(self.args.seed, barber.id, self.days)
+            mask = sum(1 << minute // SLOT_MINUTES for minute in range(schedule.start, schedule.end, schedule.step))
+            bits = asyncpg.BitString.from_int(mask, DAY_SLOTS, bitorder='little')
+            for day in self.days:
+                if works_on(schedule, day):
+                    yield barber.id, day, bits
+
+    def appointments(self):
+        row_id = 0
+        horizon = timedelta(days=max(1, self.args.days))
+        durations = {service[0]: timedelta(minutes=service[4]) for service in self.services}
+        for barber in self.barbers:
+            rng = random.Random(f'{self.args.seed}/appointments/{barber.id}')
+            schedule = barber_schedule(self.args.seed, barber.id, self.days)
+            busy_until = datetime.min
+            for moment in slots(schedule, self.days):
+                if moment < busy_until:
+                    # Still taken by a longer service, the exclusion constraint would refuse the overlap
+                    continue
+                if moment < self.today:
+                    chance = self.args.past_fill
+                else:
+                    # Bookings thin out towards the end of the schedule
+                    chance = self.args.future_fill * (1 - (moment - self.today) / horizon)
+                if rng.random() < chance:
+                    service_id = rng.choice(barber.services)
+                    end = moment + durations[service_id]
+                    if end > moment.replace(hour=0, minute=0) + timedelta(minutes=schedule.end):
+                        continue
+                    row_id += 1
+                    busy_until = end
+                    user_id = rng.randint(1, self.args.users)
+                    yield (row_id, user_id, barber.salon_id, barber.id, moment, end, rng.choice(FIRST_NAMES),
+                           f'+99890{rng.randrange(10 ** 7):07d}', service_id)
+
+
+TABLES = [
+    (User, ['id', 'user_id', 'username', 'name', 'phone', 'is_blocked'], Generator.users),
+    (Salon, ['id', 'name', 'phone', 'latitude', 'longtitude'], Generator.salons),
+    (Service, ['id', 'salon_id', 'name', 'price', 'duration_minutes'], lambda generator: iter(generator.services)),
+    (Barber, ['id', 'name', 'salon_id', 'user_id'], Generator.barber_rows),
+    (BarberService, ['id', 'barber_id', 'service_id'], Generator.barber_services),
+    (ScheduleTemplate, ['id', 'barber_id', 'weekday', 'start_time', 'end_time', 'slot_minutes'], Generator.templates),
+    (ScheduleException, ['id', 'barber_id', 'day', 'slot_minutes'], Generator.exceptions),
+    (BarberAvailability, ['id', 'barber_id', 'available_date', 'free_time'], Generator.availabilities),
+    (BarberSchedule, ['barber_id', 'day', 'slots'], Generator.schedules),
+    (Appointment, ['id', 'user_id', 'salon_id', 'barber_id', 'time', 'end_time', 'name', 'phone', 'service_id'],
+     Generator.appointments),
+]
+
+
+async def fill(args):
+    generator = Generator(args)
+    generator.plan()
+    names = [model.__tablename__ for model, _, _ in TABLES]
+
+    async with async_engine.connect() as connection:
+        raw = (await connection.get_raw_connection()).driver_connection
+        async with raw.transaction():
+            try:
+                async with raw.transaction():
+                    # The rows are consistent by construction, the per-row foreign key triggers only cost time
+                    await raw.execute('SET LOCAL session_replication_role = replica')
+            except asyncpg.InsufficientPrivilegeError:
+                print('Not a superuser, foreign keys are checked row by row')
+            await raw.execute(f'TRUNCATE outbox, slot_holds, fsm_states, {", ".join(names)} RESTART IDENTITY CASCADE')
+            # Built once after the COPY rather than row by row, checking the rows once;
+            # they never overlap by construction
+            overlap = await raw.fetchval(
+                'SELECT pg_get_constraintdef(oid) FROM pg_constraint WHERE conname = $1', OVERLAP_CONSTRAINT
+            )
+            await raw.execute(f'ALTER TABLE {Appointment.__tablename__} DROP CONSTRAINT {OVERLAP_CONSTRAINT}')
+            for model, columns, rows in TABLES:
+                started = time.perf_counter()
+                result = await raw.copy_records_to_table(model.__tablename__, records=rows(generator), columns=columns)
+                if 'id' in columns:
+                    # The ids were given explicitly, new rows must continue after them
+                    await raw.execute(
+                        f"SELECT setval(pg_get_serial_sequence('{model.__tablename__}', 'id'), "
+                        f"coalesce(max(id), 0) + 1, false) FROM {model.__tablename__}"
+                    )
+                print(f'{model.__tablename__:<24}{result.split()[-1]:>10} rows {time.perf_counter() - started:7.2f} s')
+            started = time.perf_counter()
+            await raw.execute(f'ALTER TABLE {Appointment.__tablename__} ADD CONSTRAINT {OVERLAP_CONSTRAINT} {overlap}')
+            print(f'{OVERLAP_CONSTRAINT:<40}{time.perf_counter() - started:7.2f} s')
+            # COPY skips the ORM events that tell the bots to reload salons, menus and schedules
+            await raw.execute(f'UPDATE {CatalogVersion.__tablename__} SET version = version + 1')
+        await connection.execute(text('ANALYZE'))
+        await connection.commit()
+    await async_engine.dispose()
+
+
+def run_main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--salons', type=int, default=500)
+    parser.add_argument('--barbers-per-salon', type=float, default=8, help='average, varies per salon')
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--days', type=int, default=14, help='days of schedule from today on')
+    parser.add_argument('--history-days', type=int, default=14, help='days of schedule before today')
+    parser.add_argument('--past-fill', type=float, default=0.7, help='share of past slots that were booked')
+    parser.add_argument('--future-fill', type=float, default=0.5, help='share of tomorrow\'s slots already booked')
+    parser.add_argument('--availability-rows', action='store_true', help='also write one row per free slot')
+    args = parser.parse_args()
+    if 'bench' not in DB_URL.rsplit('/', 1)[-1]:
+        sys.exit(f'Refusing to truncate {DB_URL}: the database name must contain "bench"')
+
+    upgrade_schema()
+    started = time.perf_counter()
+    asyncio.run(fill(args))
+    print(f'done in {time.perf_counter() - started:.1f} s')
+
+
+if __name__ == '__main__':
+    run_main()
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from os import getenv
+from typing import Optional, Sequence
+
+from sqlalchemy import select, literal, exists, BIGINT, delete, or_, union_all, false, func, and_, cast, DateTime, \
+    Integer
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from availability import slot_of, hours_cover, hours_bits, one_off_hours_bits, quarters_bits
+from models import Appointment, Barber, BarberSchedule, OutboxMessage, SlotHold, User, ScheduleTemplate, \
+    ScheduleException, Service, barber_span, SLOT_MINUTES, DAY_SLOTS
+
+HOLD_TTL = timedelta(seconds=int(getenv('HOLD_TTL', 600)))  # Time to type the name and phone and confirm
+HOLD_SWEEP_INTERVAL = 60  # seconds
+LOCK_NAMESPACE = 3  # First key of the pg advisory lock of a barber's holds, broadcast.py and notifier.py use 1 and 2
+
+_sweeper: Optional[asyncio.Task] = None
+
+
+def working_hours(barber_id: int, day: date):
+    """The barber's hours on `day` as BIT(DAY_SLOTS), the union availability.DaySlots.hours is built from."""
+    sources = union_all(
+        select(hours_bits(ScheduleException).label('hours')).where(
+            ScheduleException.barber_id == barber_id,
+            ScheduleException.day == day
+        ),
+        select(hours_bits(ScheduleTemplate)).where(
+            ScheduleTemplate.barber_id == barber_id,
+            ScheduleTemplate.weekday == day.weekday(),
+            ~exists().where(ScheduleException.barber_id == barber_id, ScheduleException.day == day)
+        ),
+        select(one_off_hours_bits(BarberSchedule.slots)).where(
+            BarberSchedule.barber_id == barber_id,
+            BarberSchedule.day == day
+        )
+    ).subquery()
+    return select(func.bit_or(sources.c.hours)).scalar_subquery()
+
+
+def slot_exists(barber_id: int, moment: datetime, end=None):
+    """The barber has this slot in his schedule, the same one availability.WeekSchedules expands.
+
+    With `end`, he also has to work through until then, as availability.DaySlots.offers checks.
+    """
+    slot = slot_of(moment.time())
+    if slot is None:
+        return false()
+    day = moment.date()
+    starts = or_(
+        exists().where(
+            BarberSchedule.barber_id == barber_id,
+            BarberSchedule.day == day,
+            func.get_bit(BarberSchedule.slots, slot) == 1
+        ),
+        exists().where(
+            ScheduleException.barber_id == barber_id,
+            ScheduleException.day == day,
+            hours_cover(ScheduleException, moment.time())
+        ),
+        and_(
+            exists().where(
+                ScheduleTemplate.barber_id == barber_id,
+                ScheduleTemplate.weekday == day.weekday(),
+                hours_cover(ScheduleTemplate, moment.time())
+            ),
+            ~exists().where(ScheduleException.barber_id == barber_id, ScheduleException.day == day)
+        )
+    )
+    if end is None:
+        return starts
+    # Every period [moment, end) touches must be within the hours, which end with the day
+    since_midnight = cast(end, DateTime) - datetime.combine(day, datetime.min.time())
+    end_slot = cast(func.ceil(func.extract('epoch', since_midnight) / (SLOT_MINUTES * 60)), Integer)
+    needed = quarters_bits(slot, end_slot)
+    return and_(starts, end_slot <= DAY_SLOTS, needed.op('&')(working_hours(barber_id, day)) == needed)
+
+
+def service_end(moment: datetime):
+    """End of the service starting at `moment`, for statements that select from Service."""
+    return literal(moment) + func.make_interval(0, 0, 0, 0, 0, Service.duration_minutes)
+
+
+def overlapping(model: type[Appointment] | type[SlotHold], barber_id: int, start: datetime, end):
+    # The span overlap is what the GiST index of ex_appointments_barber_overlap answers, slot_holds go by barber_id
+    span = barber_span(model.barber_id, model.time, model.end_time)
+    return and_(model.barber_id == barber_id, span.op('&&')(barber_span(barber_id, cast(start, DateTime), cast(end, DateTime))))
+
+
+def held_by_others(barber_id: int, start: datetime, end, chat_id: int, now: datetime):
+    return exists().where(
+        overlapping(SlotHold, barber_id, start, end),
+        SlotHold.chat_id != chat_id,
+        SlotHold.expires_at > now
+    )
+
+
+async def hold_slot(session: AsyncSession, chat_id: int, barber_id: int, moment: datetime, service_id: int) -> bool:
+    """Holds the time of the service starting at `moment` for the chat for HOLD_TTL.
+
+    The hold is one statement, which also drops any other hold of that chat. Fails (returns
+    False) if the slot is not in the schedule, or the service would overlap an appointment or
+    a hold of another chat that has not expired yet. Picking the same slot again just extends
+    the hold. No constraint catches holds of different starts that overlap, so the barber's
+    holds are locked before, until the caller commits, which it should do right away.
+    """
+    # A statement of its own: the snapshot of the next one then sees the holds committed before the lock
+    await session.execute(select(func.pg_advisory_xact_lock(LOCK_NAMESPACE, barber_id)))
+    now = datetime.now()
+    released = delete(SlotHold).where(
+        SlotHold.chat_id == chat_id,
+        or_(SlotHold.barber_id != barber_id, SlotHold.time != moment)
+    ).returning(SlotHold.id).cte('released')
+
+    end = service_end(moment)
+    values = select(
+        literal(chat_id, BIGINT), literal(barber_id), literal(moment), end, literal(now + HOLD_TTL)
+    ).where(
+        Service.id == service_id,
+        slot_exists(barber_id, moment, end),
+        ~exists().where(overlapping(Appointment, barber_id, moment, end)),
+        ~held_by_others(barber_id, moment, end, chat_id, now)
+    )
+    statement = insert(SlotHold).from_select(['chat_id', 'barber_id', 'time', 'end_time', 'expires_at'], values)
+    statement = statement.on_conflict_do_update(
+        index_elements=[SlotHold.barber_id, SlotHold.time],
+        set_={
+            'chat_id': statement.excluded.chat_id,
+            'end_time': statement.excluded.end_time,
+            'expires_at': statement.excluded.expires_at
+        },
+        where=or_(SlotHold.chat_id == statement.excluded.chat_id, SlotHold.expires_at <= now)
+    ).returning(SlotHold.id).add_cte(released)
+
+    return await session.scalar(statement) is not None
+
+
+async def release_holds(session: AsyncSession, chat_id: int) -> list[tuple[int, datetime]]:
+    """Drops the holds of the chat, returns the released (barber_id, time) slots."""
+    result = await session.execute(
+        delete(SlotHold).where(SlotHold.chat_id == chat_id).returning(SlotHold.barber_id, SlotHold.time)
+    )
+    return [(barber_id, moment) for barber_id, moment in result]
+
+
+async def reserve_slot(session: AsyncSession, *, chat_id: int, salon_id: int, barber_id: int, service_id: int,
+                       time: datetime, name: str, phone: str, customer_messages: Sequence[str] = (),
+                       barber_message: Optional[str] = None) -> int | None:
+    """Books the service starting at `time` and queues its notifications with one atomic statement.
+
+    The customer row is upserted, and the appointment is inserted only if the barber has the
+    slot in his schedule and no other chat holds any of its time; the exclusion constraint
+    on overlapping appointments turns a concurrent second booking into a no-op. The chat's
+    hold is dropped either way.
+    The messages land in the outbox only together with the appointment, see notifier.
+    Returns the new appointment id, or None if the slot is not (or no longer) free.
+    """
+    now = datetime.now()
+    customer = insert(User).values(user_id=chat_id, name=name, phone=phone).on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={'is_blocked': False}
+    ).returning(User.id).cte('customer')
+    released = delete(SlotHold).where(SlotHold.chat_id == chat_id).returning(SlotHold.id).cte('released')
+
+    columns = ['user_id', 'salon_id', 'barber_id', 'time', 'end_time', 'name', 'phone', 'service_id']
+    end = service_end(time)
+    values = select(
+        customer.c.id, literal(salon_id), literal(barber_id), literal(time), end, literal(name), literal(phone),
+        Service.id
+    ).select_from(customer).join(Service, Service.id == service_id).where(
+        slot_exists(barber_id, time, end),
+        ~held_by_others(barber_id, time, end, chat_id, now)
+    )
+    # No conflict target, so that the exclusion constraint is covered too
+    appointment = insert(Appointment).from_select(columns, values).on_conflict_do_nothing().returning(
+        Appointment.id
+    ).cte('appointment')
+
+    messages = []
+    if barber_message:
+        messages.append(select(Barber.user_id, literal(barber_message), literal(now), literal(now)).where(
+            Barber.id == barber_id,
+            Barber.user_id.isnot(None),
+            # No message to a barber who blocked the bot, broadcasts skip such chats too
+            ~exists(select(User.id).where(User.user_id == Barber.user_id, User.is_blocked)),
+            exists(select(appointment.c.id))
+        ))
+    messages += [
+        select(literal(chat_id, BIGINT), literal(text), literal(now), literal(now)).select_from(appointment)
+        for text in customer_messages
+    ]
+
+    statement = select(appointment.c.id).add_cte(released)
+    if messages:
+        outbox = insert(OutboxMessage).from_select(
+            ['chat_id', 'body', 'next_attempt_at', 'created_at'], union_all(*messages), include_defaults=False
+        ).returning(OutboxMessage.id).cte('notifications')
+        statement = statement.add_cte(outbox)
+
+    return await session.scalar(statement)
+
+
+async def sweep_holds(session_pool: async_sessionmaker) -> int:
+    """Deletes all expired holds in one statement."""
+    async with session_pool() as session:
+        result = await session.execute(delete(SlotHold).filter(SlotHold.expires_at <= datetime.now()))
+        await session.commit()
+    return result.rowcount
+
+
+async def _sweep_forever(session_pool: async_sessionmaker, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sweep_holds(session_pool)
+        except Exception as e:
+            logging.warning("Slot hold sweep failed: %s", e)
+
+
+def start_hold_sweeper(session_pool: async_sessionmaker, interval=HOLD_SWEEP_INTERVAL):
+    global _sweeper
+    _sweeper = asyncio.create_task(_sweep_forever(session_pool, interval))
+
+
+def stop_hold_sweeper():
+    global _sweeper
+    if _sweeper:
+        _sweeper.cancel()
+        _sweeper = None
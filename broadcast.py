@@ -0,0 +1,139 @@
+import asyncio
+import logging
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramAPIError
+from sqlalchemy import select, func
+
+from models import async_engine, async_session, Broadcast, User
+from ratelimit import TokenBucket, bulk_traffic
+
+BATCH_SIZE = 200
+CONCURRENCY = 20
+RATE = 25  # messages per second, leaves room under the global limit of ~30 for replies to users
+MAX_RETRIES = 3
+LOCK_NAMESPACE = 1  # First key of the pg advisory lock taken per broadcast
+
+bucket = TokenBucket(RATE)
+_tasks: set[asyncio.Task] = set()
+
+
+def progress_text(broadcast: Broadcast):
+    if broadcast.status == 'done':
+        return f"Reklama yuborildi !\n✅ Yetkazildi: {broadcast.delivered}\n❌ Xatolik: {broadcast.failed}"
+    return f"Reklama yuborilmoqda...\n✅ Yetkazildi: {broadcast.delivered}\n❌ Xatolik: {broadcast.failed}"
+
+
+async def start_broadcast(bot: Bot, admin_chat_id: int, photo: str, caption: str) -> Broadcast:
+    progress_message = await bot.send_message(admin_chat_id, "Reklama yuborilmoqda...")
+    async with async_session() as session:
+        broadcast = Broadcast(
+            admin_chat_id=admin_chat_id,
+            progress_message_id=progress_message.message_id,
+            photo=photo,
+            caption=caption
+        )
+        session.add(broadcast)
+        await session.commit()
+
+    _spawn(bot, broadcast.id)
+    return broadcast
+
+
+async def resume_broadcasts(bot: Bot):
+    """Continues broadcasts interrupted by a crash or restart from their saved cursor."""
+    async with async_session() as session:
+        broadcast_ids = (await session.scalars(select(Broadcast.id).filter(Broadcast.status == 'running'))).all()
+
+    for broadcast_id in broadcast_ids:
+        logging.info("Resuming broadcast %s", broadcast_id)
+        _spawn(bot, broadcast_id)
+
+
+def _spawn(bot: Bot, broadcast_id: int):
+    task = asyncio.create_task(run_broadcast(bot, broadcast_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def run_broadcast(bot: Bot, broadcast_id: int):
+    # Every bot worker resumes running broadcasts on startup, the lock lets only one of them send
+    async with async_engine.connect() as lock_connection:
+        if not await lock_connection.scalar(select(func.pg_try_advisory_lock(LOCK_NAMESPACE, broadcast_id))):
+            return
+        await lock_connection.commit()
+        try:
+            await _run_broadcast(bot, broadcast_id)
+        finally:
+            await lock_connection.execute(select(func.pg_advisory_unlock(LOCK_NAMESPACE, broadcast_id)))
+            await lock_connection.commit()
+
+
+async def _run_broadcast(bot: Bot, broadcast_id: int):
+    # Runs in its own task, so only the ad's API calls are marked as bulk
+    bulk_traffic.set(True)
+
+    async with async_session() as session:
+        broadcast = await session.get(Broadcast, broadcast_id)
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def send(chat_id: int) -> bool:
+        async with semaphore:
+            return await _send_photo(bot, chat_id, broadcast.photo, broadcast.caption)
+
+    while broadcast.status == 'running':
+        # Users are streamed by id so memory stays flat however many there are
+        async with async_session() as session:
+            users = (await session.execute(
+                select(User.id, User.user_id).filter(
+                    User.id > broadcast.last_user_id,
+                    User.user_id.isnot(None),
+                    User.is_blocked.is_(False)
+                ).order_by(User.id).limit(BATCH_SIZE)
+            )).all()
+
+        if users:
+            results = await asyncio.gather(*(send(chat_id) for _, chat_id in users))
+            broadcast.last_user_id = users[-1].id
+            broadcast.delivered += sum(results)
+            broadcast.failed += len(results) - sum(results)
+        else:
+            broadcast.status = 'done'
+            broadcast.finished_at = datetime.now()
+
+        # Progress is saved per batch, a restart repeats at most one batch
+        async with async_session() as session:
+            session.add(broadcast)
+            await session.commit()
+        await _report(bot, broadcast)
+
+
+async def _send_photo(bot: Bot, chat_id: int, photo: str, caption: str) -> bool:
+    for _ in range(MAX_RETRIES):
+        await bucket.acquire()
+        try:
+            await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption)
+            return True
+        except TelegramRetryAfter as e:
+            bucket.pause(e.retry_after)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # ReachabilityMiddleware has already marked the user, later broadcasts skip them
+            logging.info("Broadcast to %s skipped: %s", chat_id, e)
+            return False
+        except TelegramAPIError as e:
+            logging.warning("Broadcast to %s failed: %s", chat_id, e)
+            return False
+    return False
+
+
+async def _report(bot: Bot, broadcast: Broadcast):
+    try:
+        await bot.edit_message_text(
+            progress_text(broadcast),
+            chat_id=broadcast.admin_chat_id,
+            message_id=broadcast.progress_message_id
+        )
+    except TelegramAPIError as e:
+        logging.warning("Broadcast %s progress was not updated: %s", broadcast.id, e)
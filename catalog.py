@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from typing import Any, Callable, Hashable, NamedTuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from models import Salon, CatalogVersion, Service, BarberService
+
+POLL_INTERVAL = 5  # seconds
+
+
+class ServiceItem(NamedTuple):
+    id: int
+    name: str
+    price: float
+    duration: int  # minutes
+
+
+class Catalog:
+    """In-process copy of the salon catalog and of the keyboards built from it.
+
+    Everything here belongs to one catalog version. Salons, barbers and services
+    bump the version on every change (see models.bump_catalog_version), and the
+    watcher drops the cached keyboards as soon as it sees a new one.
+    """
+
+    def __init__(self):
+        self.version: int | None = None
+        self.salons: list[str] = []
+        self.salon_names: frozenset[str] = frozenset()
+        self._keyboards: dict[Hashable, Any] = {}
+        self._task: asyncio.Task | None = None
+
+    def keyboard(self, key: Hashable, build: Callable[[], Any]):
+        """Returns the markup cached under `key` for the current version, building it on first use."""
+        if key not in self._keyboards:
+            self._keyboards[key] = build()
+        return self._keyboards[key]
+
+    async def cached(self, key: Hashable, build: Callable[[], Any]):
+        """Same as `keyboard` for builders that need to query the DB."""
+        keyboards = self._keyboards
+        if key not in keyboards:
+            # Stored in the dict of the version it was built for, even if a new version arrives meanwhile
+            keyboards[key] = await build()
+        return keyboards[key]
+
+    async def barber_services(self, session: AsyncSession, barber_id: int) -> dict[str, ServiceItem]:
+        """The barber's service menu keyed by service name, loaded with one joined query."""
+        return await self.cached(('barber_services', barber_id), lambda: self._load_barber_services(session, barber_id))
+
+    @staticmethod
+    async def _load_barber_services(session: AsyncSession, barber_id: int) -> dict[str, ServiceItem]:
+        rows = await session.execute(
+            select(Service.id, Service.name, Service.price, Service.duration_minutes)
+            .join(BarberService, BarberService.service_id == Service.id)
+            .filter(BarberService.barber_id == barber_id)
+            .order_by(BarberService.id)
+        )
+        return {row.name: ServiceItem(*row) for row in rows}
+
+    async def refresh(self, session: AsyncSession):
+        version = await session.scalar(select(CatalogVersion.version).filter(CatalogVersion.id == 1))
+        if version is not None and version == self.version:
+            return
+
+        salons = (await session.scalars(select(Salon.name).order_by(Salon.id))).all()
+        self.salons = list(salons)
+        self.salon_names = frozenset(salons)
+        self._keyboards = {}
+        self.version = version
+
+    async def start(self, session_pool: async_sessionmaker, interval=POLL_INTERVAL):
+        async with session_pool() as session:
+            await self.refresh(session)
+        self._task = asyncio.create_task(self._watch(session_pool, interval))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _watch(self, session_pool: async_sessionmaker, interval):
+        # The admin panel runs in another process, so the version is polled with one cheap query
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                async with session_pool() as session:
+                    await self.refresh(session)
+            except Exception as e:
+                logging.warning("Catalog refresh failed: %s", e)
+
+
+catalog = Catalog()
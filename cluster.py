@@ -0,0 +1,333 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+from bisect import bisect
+from contextlib import asynccontextmanager
+from os import getenv
+from typing import Any
+
+import aiohttp
+import uvicorn
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.types import Update
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response, JSONResponse
+from starlette.routing import Route
+
+from scheduler import UpdateScheduler
+
+load_dotenv()
+TOKEN = getenv('BOT_TOKEN')
+BOT_API_URL = getenv('BOT_API_URL')
+WEBHOOK_PATH = getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = getenv('WEBHOOK_SECRET')
+
+BASE_PORT = 8101  # Spawned workers listen on BASE_PORT, BASE_PORT + 1, ...
+VIRTUAL_NODES = 100  # Points per worker on the hash ring, evens out the share of chats
+FORWARDERS = 64  # Updates the front has in flight at once
+HEALTH_INTERVAL = 2  # seconds
+HEALTH_TIMEOUT = 1  # seconds
+MAX_HEALTH_FAILURES = 2  # Missed checks before a worker's chats move to the others
+RESPAWN_DELAY = 1  # seconds
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent hashing of chats onto workers.
+
+    Removing a worker moves only the chats it owned, adding it back returns exactly
+    those, so every other user keeps talking to the same process.
+    """
+
+    def __init__(self, virtual_nodes=VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self.nodes: set[str] = set()
+        self._points: list[int] = []
+        self._owners: list[str] = []
+
+    def add(self, node: str):
+        self.nodes.add(node)
+        self._build()
+
+    def remove(self, node: str):
+        self.nodes.discard(node)
+        self._build()
+
+    def get(self, key) -> str | None:
+        if not self._points:
+            return None
+        return self._owners[bisect(self._points, _hash(str(key))) % len(self._points)]
+
+    def _build(self):
+        ring = sorted((_hash(f'{node}#{index}'), node) for node in self.nodes for index in range(self.virtual_nodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [node for _, node in ring]
+
+
+class Front(UpdateScheduler):
+    """Hands every update to the worker that owns its chat.
+
+    Runs the updates through the UpdateScheduler machinery, so a chat's next update is
+    forwarded only after the worker finished the previous one, and watches the workers'
+    /health to take dead ones off the ring and put recovered ones back.
+    """
+
+    def __init__(self, bot: Bot, worker_urls: list[str], forwarders=FORWARDERS):
+        super().__init__(None, bot, forwarders)
+        self.worker_urls = worker_urls
+        self.ring = HashRing()
+        self.allowed_updates: list[str] | None = None
+        self._failures = {url: 0 for url in worker_urls}
+        self._http: aiohttp.ClientSession | None = None
+        self._watcher: asyncio.Task | None = None
+
+    @staticmethod
+    def route_key(update: Update):
+        context = UserContextMiddleware.resolve_event_context(update)
+        if context.chat:
+            return context.chat.id
+        return context.user.id if context.user else update.update_id
+
+    async def open(self):
+        self._http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None))
+        # The first round decides which workers take traffic from the start
+        await asyncio.gather(*(self._check(url) for url in self.worker_urls))
+        self._watcher = asyncio.create_task(self._watch())
+        self.start()
+
+    async def close(self):
+        await self.stop()
+        if self._watcher:
+            self._watcher.cancel()
+        await self._http.close()
+
+    async def handle(self, update: Update, answer: bool) -> Any:
+        data = update.model_dump(mode='json', exclude_unset=True, by_alias=True)
+        key = self.route_key(update)
+        while True:
+            url = self.ring.get(key)
+            if url is None:
+                raise RuntimeError('No healthy bot workers')
+            try:
+                async with self._http.post(f'{url}/update', params={'answer': int(answer)}, json=data) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    if response.status != 204:
+                        logging.warning("Worker %s failed update %s: HTTP %s", url, update.update_id, response.status)
+                    return None
+            except aiohttp.ClientConnectorError:
+                # Nothing was delivered, so the next owner of the chat can take it
+                self._mark_down(url)
+
+    def _mark_down(self, url: str):
+        self._failures[url] = MAX_HEALTH_FAILURES
+        if url in self.ring.nodes:
+            self.ring.remove(url)
+            logging.warning("Worker %s is down, its chats move to %s others", url, len(self.ring.nodes))
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(HEALTH_INTERVAL)
+            await asyncio.gather(*(self._check(url) for url in self.worker_urls))
+
+    async def _check(self, url: str):
+        try:
+            async with self._http.get(f'{url}/health', timeout=aiohttp.ClientTimeout(total=HEALTH_TIMEOUT)) as response:
+                health = await response.json() if response.status == 200 else None
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            health = None
+
+        if health is None:
+            self._failures[url] += 1
+            if self._failures[url] >= MAX_HEALTH_FAILURES:
+                self._mark_down(url)
+            return
+
+        self._failures[url] = 0
+        self.allowed_updates = health['allowed_updates']
+        if url not in self.ring.nodes:
+            self.ring.add(url)
+            logging.info("Worker %s is up, %s workers take updates", url, len(self.ring.nodes))
+
+
+def create_front_bot() -> Bot:
+    # Only polls getUpdates, everything the handlers send goes out from the workers
+    api = TelegramAPIServer.from_base(BOT_API_URL) if BOT_API_URL else PRODUCTION
+    return Bot(token=TOKEN, session=AiohttpSession(api=api))
+
+
+async def spawn_workers(count: int, base_port: int) -> tuple[list[str], list[asyncio.Task]]:
+    """Starts `count` local worker processes and keeps restarting the ones that exit.
+
+    Cancelling the returned tasks stops the workers.
+    """
+    # Telegram's global limit counts for the bot as a whole, each worker gets its share
+    from middlewares import GLOBAL_RATE
+    env = dict(os.environ, BOT_GLOBAL_RATE=str(GLOBAL_RATE / count))
+
+    async def supervise(port: int):
+        while True:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'cluster', 'worker', '--port', str(port), env=env
+            )
+            try:
+                code = await process.wait()
+            except asyncio.CancelledError:
+                process.terminate()
+                await process.wait()
+                raise
+            logging.warning("Worker on port %s exited with %s, restarting", port, code)
+            await asyncio.sleep(RESPAWN_DELAY)
+
+    ports = range(base_port, base_port + count)
+    supervisors = [asyncio.create_task(supervise(port)) for port in ports]
+    return [f'http://127.0.0.1:{port}' for port in ports], supervisors
+
+
+async def run_front(args):
+    from migrations import upgrade_schema
+
+    # Once here instead of racing in every worker
+    await asyncio.to_thread(upgrade_schema)
+    worker_urls, supervisors = list(args.worker), []
+    if args.spawn:
+        spawned, supervisors = await spawn_workers(args.spawn, args.base_port)
+        worker_urls += spawned
+    bot = create_front_bot()
+    front = Front(bot, worker_urls, args.forwarders)
+
+    while True:
+        await front.open()
+        if front.ring.nodes:
+            break
+        # Spawned workers need a moment to import the bot and connect to the database
+        await front.close()
+        await asyncio.sleep(HEALTH_INTERVAL)
+
+    try:
+        if args.webhook:
+            await serve_front_webhook(front, args.port)
+        else:
+            await bot.delete_webhook()
+            await front.run_polling(allowed_updates=front.allowed_updates)
+    finally:
+        await front.close()
+        await bot.session.close()
+        for supervisor in supervisors:
+            supervisor.cancel()
+        await asyncio.gather(*supervisors, return_exceptions=True)
+
+
+async def serve_front_webhook(front: Front, port: int):
+    async def telegram_webhook(request: Request) -> Response:
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return Response(status_code=401)
+        update = Update.model_validate(await request.json(), context={'bot': front.bot})
+        payload = await (await front.submit(update, answer=False))
+        return JSONResponse(payload) if payload else Response()
+
+    if WEBHOOK_URL:
+        await front.bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=front.allowed_updates
+        )
+    app = Starlette(routes=[Route(WEBHOOK_PATH, telegram_webhook, methods=['POST'])])
+    await uvicorn.Server(uvicorn.Config(app, host='0.0.0.0', port=port)).serve()
+
+
+def worker_app() -> Starlette:
+    """One bot process: the full dispatcher behind /update, fed by the front."""
+    from aiogram.methods import TelegramMethod
+
+    from handlers import dp
+    from main import create_bot, method_payload
+
+    bot = create_bot()
+    scheduler = UpdateScheduler(dp, bot)
+
+    async def update_endpoint(request: Request) -> Response:
+        update = Update.model_validate(await request.json(), context={'bot': bot})
+        answer = request.query_params.get('answer') == '1'
+        result = await (await scheduler.submit(update, answer=answer))
+        if not isinstance(result, TelegramMethod):
+            return Response(status_code=204)
+
+        payload, files = method_payload(bot, result)
+        if files:
+            await dp.silent_call_request(bot, result)
+            return Response(status_code=204)
+        return JSONResponse(payload)
+
+    async def health(request: Request) -> Response:
+        stats = scheduler.stats()
+        return JSONResponse({
+            'pid': os.getpid(),
+            'allowed_updates': dp.resolve_used_update_types(),
+            'pending': stats.pending,
+            'running': stats.running,
+            'processed': stats.processed,
+        })
+
+    @asynccontextmanager
+    async def lifespan(app: Starlette):
+        await dp.emit_startup(bot=bot, dispatcher=dp)
+        scheduler.start()
+        yield
+        await scheduler.stop()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
+
+    return Starlette(routes=[
+        Route('/update', update_endpoint, methods=['POST']),
+        Route('/health', health, methods=['GET']),
+    ], lifespan=lifespan)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Multi-process mode: a front process receives the updates and hands each chat to one of the '
+        'bot workers, chosen by consistent hashing of the chat id.'
+    ))
+    roles = parser.add_subparsers(dest='role', required=True)
+
+    front = roles.add_parser('front', help='receive updates (polling, or --webhook) and route them')
+    front.add_argument('--spawn', type=int, default=0, help='start this many local workers')
+    front.add_argument('--base-port', type=int, default=BASE_PORT, help='port of the first spawned worker')
+    front.add_argument('--worker', action='append', default=[], help='url of a worker started separately')
+    front.add_argument('--forwarders', type=int, default=FORWARDERS)
+    front.add_argument('--webhook', action='store_true', help='receive updates on WEBHOOK_PATH instead of polling')
+    front.add_argument('--port', type=int, default=8080, help='webhook port')
+
+    worker = roles.add_parser('worker', help='run the bot handlers behind /update')
+    worker.add_argument('--host', default='127.0.0.1')
+    worker.add_argument('--port', type=int, default=BASE_PORT)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    if args.role == 'worker':
+        uvicorn.run(worker_app(), host=args.host, port=args.port, log_level='warning')
+    elif not args.spawn and not args.worker:
+        parser.error('front needs --spawn or --worker')
+    else:
+        try:
+            asyncio.run(run_front(args))
+        except KeyboardInterrupt:
+            pass  # Workers were stopped on the way out
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+from aiogram.filters import BaseFilter
+from aiogram.types import Message
+
+from catalog import catalog
+
+
+class SalonNameFilter(BaseFilter):
+    """Matches a message whose text is one of the salon names, using the in-process catalog."""
+
+    async def __call__(self, message: Message) -> bool:
+        return message.text in catalog.salon_names
@@ -1,15 +1,59 @@
-from aiogram import Dispatcher
+from aiogram import Dispatcher, Bot
 
+import metrics
+from booking import start_hold_sweeper, stop_hold_sweeper
+from broadcast import resume_broadcasts
+from catalog import catalog
 from handlers.admin import admin_router
 from handlers.inform import inform_router
 from handlers.start import start_router
+from middlewares import DbSessionMiddleware, FSMFlushMiddleware, MetricsMiddleware, HandlerNameMiddleware, \
+    ProfilerMiddleware
+from models import async_session, async_engine
+from notifier import notifier
+from profiler import profiler
+from storage import SQLAlchemyStorage
 
 # from handlers.start import start_router
 
-dp = Dispatcher()
+storage = SQLAlchemyStorage(async_session)
+dp = Dispatcher(storage=storage)
+# Moved inside MetricsMiddleware, so the FSM state read counts towards the update too
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(MetricsMiddleware())
+dp.update.outer_middleware(dp.fsm)
+dp.update.outer_middleware(FSMFlushMiddleware(storage))
+dp.update.outer_middleware(DbSessionMiddleware(async_session))
 dp.include_routers(*[
     start_router,
     inform_router,
     admin_router,
 
 ])
+# Inner middlewares of the dispatcher's observers also run for the handlers of the included routers
+for event_name, observer in dp.observers.items():
+    if event_name not in ('update', 'error'):
+        observer.middleware(HandlerNameMiddleware())
+        observer.middleware(ProfilerMiddleware())
+metrics.instrument_engine(async_engine)
+
+
+@dp.startup()
+async def on_startup(bot: Bot):
+    await catalog.start(async_session)
+    await storage.start_sweeper()
+    start_hold_sweeper(async_session)
+    await notifier.start(bot, async_session)
+    await resume_broadcasts(bot)
+    metrics.start_exporter()
+    profiler.start()
+
+
+@dp.shutdown()
+async def on_shutdown():
+    await catalog.stop()
+    stop_hold_sweeper()
+    await notifier.stop()
+    await storage.close()
+    metrics.stop_exporter()
+    profiler.stop()
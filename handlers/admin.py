@@ -1,17 +1,22 @@
-import asyncio
 import os
 from datetime import datetime
 
-import aiogram
 from aiogram import Router, F
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.types import KeyboardButton, Message
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 from dotenv import load_dotenv
-
-from handlers.inform import get_available_times
-from keyboards import main_menu_button
-from models import session, User, Barber, Salon, Service
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import profiler
+from availability import slot_index
+from broadcast import start_broadcast
+from catalog import catalog
+from filters import SalonNameFilter
+from keyboards import main_menu_button, salon_list_button
+from models import User, Salon, Service
 from state import AdminState
 
 
@@ -29,115 +34,118 @@ admin_router = Router()
 
 
 @admin_router.message(F.text == "Admin Bo'limi")
-async def admin(message: Message):
+async def admin_panel_link(message: Message):
     link = 'http://k.feniks.best:8050'
-    await message.answer(text=f'Admin Bolimi ga otish {link}')
+    return message.answer(text=f'Admin Bolimi ga otish {link}')
 
 
 @admin_router.message(F.text == 'Reklama 🔊', F.from_user.id == int(os.getenv('ADMIN_ID')))
-async def admin(message: Message, state: FSMContext):
-    await message.answer("Reklama rasmini kiriting !")
+async def start_ad(message: Message, state: FSMContext):
     await state.set_state(AdminState.photo)
+    return message.answer("Reklama rasmini kiriting !")
 
 
 # Handle photo upload for the ad
 @admin_router.message(AdminState.photo, F.from_user.id == int(os.getenv('ADMIN_ID')), ~F.text, F.photo)
-async def admin(message: Message, state: FSMContext):
+async def ad_photo(message: Message, state: FSMContext):
     photo = message.photo[-1].file_id
     await state.update_data({"photo": photo})
     await state.set_state(AdminState.title)
-    await message.answer("Reklama haqida to'liq malumot bering !")
+    return message.answer("Reklama haqida to'liq malumot bering !")
 
 
 @admin_router.message(AdminState.title, F.from_user.id == int(os.getenv('ADMIN_ID')), ~F.photo)
-async def admin(message: Message, state: FSMContext):
+async def ad_title(message: Message, state: FSMContext, session: AsyncSession):
     title = message.text
     await state.update_data({"title": title})
 
     data = await state.get_data()
     await state.clear()
 
-    users = session.query(User).filter(User.user_id.isnot(None)).all()
+    has_users = await session.scalar(
+        select(User.id).filter(User.user_id.isnot(None), User.is_blocked.is_(False)).limit(1)
+    )
 
-    if not users:
+    if not has_users:
         await message.answer("Hech kimga reklama yuborilmadi. Foydalanuvchilar mavjud emas.")
         return
 
-    tasks = []
-    for user in users:
-        if user.user_id:
-            try:
+    # Sending runs in the background, progress is reported by editing one message
+    await start_broadcast(message.bot, message.chat.id, data['photo'], data['title'])
+
 
-                chat_member = await message.bot.get_chat_member(user.user_id, user.user_id)
+PROFILE_USAGE = "/profile off | /profile 0.05 | /profile show_salon_details [0.5]"
 
-                if chat_member.status == 'left' or chat_member.status == 'kicked':
-                    print(f'User {user.user_id} has blocked the bot or left the chat. Skipping.')
-                    continue
 
-                tasks.append(message.bot.send_photo(
-                    chat_id=user.user_id,
-                    photo=data['photo'],
-                    caption=data['title']
-                ))
+def profile_rate(text: str) -> float:
+    # Raises ValueError on anything but a number, like the Profiles page it keeps the share within 0..1
+    return max(0.0, min(float(text), 1.0))
 
-            except aiogram.exceptions.TelegramForbiddenError:
 
-                print(f'User {user.user_id} has blocked the bot. Skipping this user.')
-                continue
+@admin_router.message(Command('profile'), F.from_user.id == int(os.getenv('ADMIN_ID')))
+async def profile_updates(message: Message, command: CommandObject):
+    args = (command.args or '').split()
+    try:
+        if not args:
+            settings = profiler.profiler.settings
+        elif args == ['off']:
+            settings = profiler.OFF
+        elif len(args) == 1 and not args[0].isidentifier():
+            settings = profiler.Settings(profile_rate(args[0]))
+        elif len(args) <= 2 and args[0].isidentifier():
+            # Handler names are function names
+            settings = profiler.Settings(profile_rate(args[1]) if len(args) == 2 else 1.0, args[0])
+        else:
+            raise ValueError
+    except ValueError:
+        return message.answer(f"Noto'g'ri buyruq. {PROFILE_USAGE}")
 
-            except aiogram.exceptions.TelegramBadRequest as e:
+    if args:
+        # Every bot process follows the control file, this one switches right away
+        profiler.write_settings(settings)
+        profiler.profiler.apply(settings)
 
-                if "chat not found" in str(e):
-                    print(f'User {user.user_id} not found. Skipping.')
-                else:
-                    print(f'Failed to send to user {user.user_id}: {e}')
-                continue
-    await message.answer("Reklama yuborildi !")
-    if tasks:
-        await asyncio.gather(*tasks)
+    if settings.rate:
+        status = f"Profil yozilmoqda: {settings.rate:.0%} yangilanishlar, {settings.handler or 'barcha handlerlar'}."
+    else:
+        status = "Profil yozish o'chirilgan."
+    lines = [
+        f"- {handler}: {samples} ta, o'rtacha {seconds / (samples or 1) * 1000:.0f} ms"
+        for handler, samples, seconds in profiler.summaries()
+    ]
+    return message.answer('\n'.join([status, *lines, PROFILE_USAGE]))
 
 
 @admin_router.message(F.text == 'Ортга')
 async def back_to(message: Message):
-    await message.answer('Бош меню ✅', reply_markup=main_menu_button())
+    return message.answer('Бош меню ✅', reply_markup=main_menu_button())
 
 
 @admin_router.message(F.text == 'Салонлар 💇🏻')
 async def show_salon_list(message: Message):
-    salons = session.query(Salon).all()
-    if salons:
-        rkb = ReplyKeyboardBuilder()
-        for salon in salons:
-            rkb.add(KeyboardButton(text=salon.name))  # List salon names
-
-        rkb.add(KeyboardButton(text="Ортга"))  # Back button
-        rkb.adjust(2)
+    if catalog.salons:
         await message.answer(
             "Сартарошхоналардан бирини танланг:",
-            reply_markup=rkb.as_markup(resize_keyboard=True)
+            reply_markup=salon_list_button(with_back=True)
         )
     else:
         await message.answer("Ҳозирда сартарошхоналар мавжуд эмас.")
 
 
-@admin_router.message(lambda message: message.text in [salon.name for salon in session.query(Salon).all()])
-async def show_salon_details(message: Message):
+@admin_router.message(SalonNameFilter())
+async def show_salon_details(message: Message, session: AsyncSession):
     salon_name = message.text
-    salon = session.query(Salon).filter(Salon.name == salon_name).first()
+    salon = await session.scalar(select(Salon).filter(Salon.name == salon_name).limit(1))
 
     if salon:
         # Get services for the selected salon
-        services = session.query(Service).filter(Service.salon_id == salon.id).all()
-
-        # Get barbers who have available times
-        barbers = session.query(Barber).filter(Barber.salon_id == salon.id).all()
+        services = (await session.scalars(select(Service).filter(Service.salon_id == salon.id))).all()
 
-        # Filter barbers that have at least one available time slot
-        barbers_with_available_times = []
-        for barber in barbers:
-            available_times = get_available_times(barber.id, str(datetime.today().date()))
-            if available_times:  # Barber has available time slots
-                barbers_with_available_times.append(barber)
+        # Barbers that have at least one available time slot today
+        barbers_with_available_times = [
+            barber for barber, slots in await slot_index.get_salon(session, salon.id, datetime.today().date())
+            if slots.bookable()
+        ]
 
         # Format services and barbers into lists
         services_list = '\n'.join(
@@ -1,55 +1,49 @@
-from aiogram import Bot, Router, F
+from aiogram import Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.types import KeyboardButton, Message, ReplyKeyboardRemove, CallbackQuery, InlineKeyboardMarkup, \
     InlineKeyboardButton
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from availability import slot_index, get_calendar
+from booking import reserve_slot, hold_slot, release_holds
+from catalog import catalog
 from keyboards import main_menu_button, salon_list_button, service_list_button
-from models import User, session, Appointment, Barber, Salon, BarberAvailability, BarberService, Service
+from models import Barber, Salon, SLOT_MINUTES
+from notifier import notifier
 from state import Booking
 
 inform_router = Router()
 
 
-def get_available_times(barber_id, selected_date):
+async def get_available_times(session: AsyncSession, barber_id, selected_date, duration=SLOT_MINUTES):
     selected_date_obj = datetime.strptime(selected_date, '%Y-%m-%d').date()
 
-    # Tanlangan barber uchun tanlangan kunda bo'sh vaqtlarni olish
-    available_times = session.query(BarberAvailability).filter(
-        BarberAvailability.barber_id == barber_id,
-        func.date(BarberAvailability.available_date) == selected_date_obj
-    ).all()
+    # Tanlangan barber uchun tanlangan kunda xizmat davomiyligi sig'adigan bo'sh vaqtlar
+    return await slot_index.free_times(session, barber_id, selected_date_obj, duration)
 
-    if not available_times:
-        return []
-
-    existing_appointments = session.query(Appointment).filter(
-        Appointment.barber_id == barber_id
-    ).all()
-
-    # Band bo'lgan vaqtlarni olish
-    booked_times = [appointment.time.strftime('%H:%M') for appointment in existing_appointments]
-
-    available_time_slots = [
-        availability.free_time.strftime('%H:%M') for availability in available_times
-        if availability.free_time.strftime('%H:%M') not in booked_times
-    ]
 
-    return available_time_slots
+def time_list_button(available_times):
+    rkb = ReplyKeyboardBuilder()
+    for time in available_times:
+        rkb.add(KeyboardButton(text=time))
 
+    rkb.adjust(2)
+    return rkb.as_markup(resize_keyboard=True)
 
 
 @inform_router.message(F.text == 'Соч олдириш 💇')
-async def choose_salon(message: Message, state: FSMContext):
-    await message.answer('Сартарошхона танланг:', reply_markup=salon_list_button())
+async def start_booking(message: Message, state: FSMContext):
     await state.set_state(Booking.salon)
+    return message.answer('Сартарошхона танланг:', reply_markup=salon_list_button())
 
 
 # Salonni tanlash
 @inform_router.message(Booking.salon)
-async def choose_salon(message: Message, state: FSMContext):
+async def choose_salon(message: Message, state: FSMContext, session: AsyncSession):
     salon_name = message.text
-    salon = session.query(Salon).filter(Salon.name == salon_name).first()
+    salon = await session.scalar(select(Salon).filter(Salon.name == salon_name).limit(1))
 
     if not salon:
         await message.answer("Бу сартарошхона топилмади. Илтимос, бошқа номини танланг.")
@@ -59,12 +53,11 @@ async def choose_salon(message: Message, state: FSMContext):
 
     selected_date = str(datetime.today().date())
 
-    # Salonning barberlarini va bo'sh vaqtlarini tekshirish
-    available_barbers = []
-    for barber in salon.barbers:
-        available_times = get_available_times(barber.id, selected_date)
-        if available_times:
-            available_barbers.append(barber)
+    # Salonning barberlarini va bo'sh vaqtlarini bitta so'rovda tekshirish
+    available_barbers = [
+        barber for barber, slots in await slot_index.get_salon(session, salon.id, datetime.today().date())
+        if slots.bookable()
+    ]
 
     if not available_barbers:
         await message.answer(f"Бу сартарошхонада {selected_date} кунда буш сартарошлар мавжуд эмас.", reply_markup=main_menu_button())
@@ -85,19 +78,19 @@ async def choose_salon(message: Message, state: FSMContext):
 
 # Barberni tanlash
 @inform_router.message(Booking.barber)
-async def choose_barber(message: Message, state: FSMContext):
+async def choose_barber(message: Message, state: FSMContext, session: AsyncSession):
     barber_name = message.text
     selected_date = str(datetime.today().date())
 
     # Barberni tanlash
-    barber = session.query(Barber).filter(Barber.name == barber_name).first()
+    barber = await session.scalar(select(Barber).filter(Barber.name == barber_name).limit(1))
 
     if not barber:
         await message.answer("Бу сартарош топилмади. Илтимос, бошқа номини танланг.")
         return
 
     # Barberning bo'sh vaqtlarini tekshirish
-    available_times = get_available_times(barber.id, selected_date)
+    available_times = await get_available_times(session, barber.id, selected_date)
 
     if not available_times:
         await message.answer(f"Бу сартарошнинг {selected_date} кунда бўш вақти йўқ. Илтимос, бошқа сартарошни танланг.")
@@ -107,39 +100,36 @@ async def choose_barber(message: Message, state: FSMContext):
     await state.update_data(barber_name=barber.name, barber_id=barber.id)
 
     # Xizmatlar ro'yxatini olish
-    services_keyboard = service_list_button(barber.id)
+    services_keyboard = await service_list_button(session, barber.id)
     await message.answer("Илтимос, хизматни танланг:", reply_markup=services_keyboard)
     await state.set_state(Booking.service)
 
 
 @inform_router.message(Booking.service)
-async def choose_service(message: Message, state: FSMContext):
+async def choose_service(message: Message, state: FSMContext, session: AsyncSession):
     service_name = message.text
     user_data = await state.get_data()
     barber_id = user_data.get("barber_id")
+    barber_name = user_data.get("barber_name")
 
-    barber = session.query(Barber).filter(Barber.id == barber_id).first()
-
-    if not barber:
+    if not barber_id:
         await message.answer("Сартарош топилмади. Илтимос, қайтадан уринган кўринг.")
         return
 
-    barber_service = session.query(BarberService).join(Service).filter(
-        BarberService.barber_id == barber.id,
-        Service.name == service_name
-    ).first()
+    # Resolved from the same cached menu the keyboard was built from
+    service = (await catalog.barber_services(session, barber_id)).get(service_name)
 
-    if not barber_service:
+    if not service:
         await message.answer("Бу хизмат сартарошда мавжуд эмас. Илтимос, бошқа хизматни танланг.")
         return
 
-    await state.update_data(service_name=service_name, service_id=barber_service.service_id)
+    await state.update_data(service_name=service_name, service_id=service.id, duration=service.duration)
 
-    available_dates = get_available_dates(barber_id)
+    available_dates = await get_available_dates(session, barber_id, service.duration)
 
     if not available_dates:
         await message.answer(
-            f"Ҳозирда {barber.name} нинг бўш кунлар мавжуд эмас. Илтимос, кейинроқ қайта уринган кўринг.")
+            f"Ҳозирда {barber_name} нинг бўш кунлар мавжуд эмас. Илтимос, кейинроқ қайта уринган кўринг.")
         return
 
     rkb = ReplyKeyboardBuilder()
@@ -154,47 +144,22 @@ async def choose_service(message: Message, state: FSMContext):
     await state.set_state(Booking.date)
 
 
-from datetime import datetime, timedelta
-from sqlalchemy.sql import func
-
-
-def get_available_dates(barber_id):
-    today = datetime.today()
-    next_7_days = [today + timedelta(days=i) for i in range(6)]  # Keyingi 7 kun
-    available_dates = []
-
-    for day in next_7_days:
-        day_start = datetime.combine(day, datetime.min.time())  # Kun boshlanishi
-        day_end = datetime.combine(day, datetime.max.time())  # Kun oxiri
+from datetime import datetime
 
-        # Ushbu kunga sartaroshning bo'sh vaqtlarini olish
-        barber_availability = session.query(BarberAvailability).filter(
-            BarberAvailability.barber_id == barber_id,
-            func.date(BarberAvailability.available_date) == day.date()
-        ).all()
 
-        if barber_availability:
-            # Ushbu kunga allaqachon band qilingan uchrashuvlarni tekshirish
-            existing_appointments = session.query(Appointment).filter(
-                Appointment.barber_id == barber_id,
-                Appointment.time >= day_start,
-                Appointment.time <= day_end
-            ).all()
-
-            # Agar band bo'lmagan vaqtlar mavjud bo'lsa, sanani qo'shish
-            if not existing_appointments:
-                available_dates.append(day.strftime('%Y-%m-%d'))
-
-    return available_dates
+async def get_available_dates(session: AsyncSession, barber_id, duration=SLOT_MINUTES):
+    # Keyingi CALENDAR_DAYS kun ichida xizmat sig'adigan kamida bitta bo'sh vaqti bor kunlar
+    calendar = await get_calendar(session, barber_id, datetime.today().date(), duration=duration)
+    return [day.strftime('%Y-%m-%d') for day, free_slots in calendar.items() if free_slots > 0]
 
 
 @inform_router.message(Booking.date)
-async def choose_date(message: Message, state: FSMContext):
+async def choose_date(message: Message, state: FSMContext, session: AsyncSession):
     selected_date = message.text
     user_data = await state.get_data()
     barber_id = user_data.get("barber_id")
 
-    available_times = get_available_times(barber_id, selected_date)
+    available_times = await get_available_times(session, barber_id, selected_date, user_data.get("duration", SLOT_MINUTES))
 
     if not available_times:
         await message.answer("Ушбу санада бу Сартарошнинг бўш вақти мавжуд эмас. Илтимос, бошқа сана танланг.",
@@ -204,29 +169,51 @@ async def choose_date(message: Message, state: FSMContext):
 
     await state.update_data(selected_date=selected_date)  # Sana saqlanadi
 
-    rkb = ReplyKeyboardBuilder()
-    for time in available_times:
-        rkb.add(KeyboardButton(text=time))
-
-    rkb.adjust(2)
     await message.answer(
         f"Ушбу санадаги: {selected_date}. Бўш вақтлардан бирини танланг:",
-        reply_markup=rkb.as_markup(resize_keyboard=True)
+        reply_markup=time_list_button(available_times)
     )
     await state.set_state(Booking.time)
 
 
 @inform_router.message(Booking.time)
-async def choose_time(message: Message, state: FSMContext):
+async def choose_time(message: Message, state: FSMContext, session: AsyncSession):
     selected_time = message.text
     user_data = await state.get_data()
     barber_id = user_data.get("barber_id")
     selected_date = user_data.get("selected_date")
+    duration = user_data.get("duration", SLOT_MINUTES)
+
+    try:
+        moment = datetime.strptime(f'{selected_date} {selected_time}', '%Y-%m-%d %H:%M')
+    except (TypeError, ValueError):
+        await message.answer("Илтимос, рўйхатдаги вақтлардан бирини танланг.")
+        return
+
+    # Xizmat ish vaqti tugaguncha sig'ishi kerak; shundan keyin butun davomiyligi boshqa mijozlarga
+    # band bo'lib ko'rinadi, tasdiqlash yoki HOLD_TTL tugaguncha
+    held = (await slot_index.offers(session, barber_id, moment, duration)
+            and await hold_slot(session, message.from_user.id, barber_id, moment, user_data.get("service_id")))
+    await session.commit()
+    slot_index.invalidate(barber_id, moment.date())
+
+    if not held:
+        available_times = await get_available_times(session, barber_id, selected_date, duration)
+        if not available_times:
+            await state.clear()
+            return message.answer(
+                "Ушбу санада бу Сартарошнинг бўш вақти қолмади. Илтимос, қайтадан уриниб кўринг.",
+                reply_markup=main_menu_button()
+            )
+        return message.answer(
+            "Бу вақт банд. Илтимос, бошқа вақтни танланг:",
+            reply_markup=time_list_button(available_times)
+        )
 
     await state.update_data(time=selected_time)
 
-    await message.answer("Исмингизни киритинг:", reply_markup=ReplyKeyboardRemove())
     await state.set_state(Booking.name)
+    return message.answer("Исмингизни киритинг:", reply_markup=ReplyKeyboardRemove())
 
 
 @inform_router.message(Booking.name)
@@ -234,8 +221,8 @@ async def get_name(message: Message, state: FSMContext):
     user_name = message.text
     await state.update_data(name=user_name)
 
-    await message.answer("Телефон рақамингизни киритинг:", reply_markup=ReplyKeyboardRemove())
     await state.set_state(Booking.phone)
+    return message.answer("Телефон рақамингизни киритинг:", reply_markup=ReplyKeyboardRemove())
 
 
 @inform_router.message(Booking.phone)
@@ -261,13 +248,18 @@ async def get_phone(message: Message, state: FSMContext):
         ]
     ])
 
-    await message.answer(confirmation_message, reply_markup=inline_kb)
+    return message.answer(confirmation_message, reply_markup=inline_kb)
 
 
 @inform_router.callback_query(F.data == "confirm_booking")
-async def confirm_booking(callback_query: CallbackQuery, state: FSMContext, bot: Bot):
+async def confirm_booking(callback_query: CallbackQuery, state: FSMContext, session: AsyncSession):
     user_id = callback_query.from_user.id
     data = await state.get_data()
+
+    if 'time' not in data:
+        # Already confirmed (or cancelled), e.g. the button was tapped twice
+        return callback_query.answer()
+
     name = data.get("name")
     salon_id = int(data.get("salon_id"))
     salon_name = data.get("salon_name")
@@ -282,46 +274,52 @@ async def confirm_booking(callback_query: CallbackQuery, state: FSMContext, bot:
     # Convert the time string to a time object (HH:MM)
     time_obj = datetime.strptime(time_str, '%H:%M').time()
 
-    # Combine time with today's date (use a specific date if needed)
-    today = datetime.today()
-    time_with_date = datetime.combine(today, time_obj)
-
-    # Check if the user exists in the database
-    user = session.query(User).filter(User.user_id == user_id).first()
+    # Combine time with the selected date
+    selected_day = datetime.strptime(day, '%Y-%m-%d').date()
+    time_with_date = datetime.combine(selected_day, time_obj)
 
-    if not user:
-        user = User(user_id=user_id, name=name, phone=phone)
-        session.add(user)
-        session.commit()
+    # Create the appointment details message
+    appointment_details = f"🆕 Янги буюртма:\n👤 Исм: {name}\n🏠 Сартарошхона: {salon_name}\n💈 Сартарош: {barber_name}\n💇‍♂️ Хизмат: {service_name}\n🌞Кун: {day}\n⏰ Вақт: {time_with_date.strftime('%H:%M')}\n📞 Телефон: {phone}"
 
     try:
-        # Fetch the barber's user ID using the barber's ID
-        barber_user = session.query(Barber).filter(Barber.id == barber_id).first()
-
-        # Create the appointment details message
-        appointment_details = f"🆕 Янги буюртма:\n👤 Исм: {name}\n🏠 Сартарошхона: {salon_name}\n💈 Сартарош: {barber_name}\n💇‍♂️ Хизмат: {service_name}\n🌞Кун: {day}\n⏰ Вақт: {time_with_date.strftime('%H:%M')}\n📞 Телефон: {phone}"
-
-        # Send confirmation to the barber if available
-        if barber_user and barber_user.user_id:
-            await bot.send_message(barber_user.user_id, appointment_details)
-
-        # Send confirmation to the user
-        if user_id:
-            await bot.send_message(user_id, appointment_details)
-            await bot.send_message(callback_query.from_user.id, "Буюртмангиз муваффақиятли тасдиқланди!")
-
-        # Create the appointment in the database
-        appointment = Appointment(
-            user_id=user.id,
+        # Bitta so'rov: mijoz, band qilish va xabarlar (outbox) birga yoziladi yoki hech biri
+        appointment_id = await reserve_slot(
+            session,
+            chat_id=user_id,
             salon_id=salon_id,
             barber_id=barber_id,
-            time=time_with_date,  # Use the combined datetime object
+            service_id=service,
+            time=time_with_date,
             name=name,
             phone=phone,
-            service_id=service
+            barber_message=appointment_details,
+            customer_messages=[appointment_details, "Буюртмангиз муваффақиятли тасдиқланди!"]
         )
-        session.add(appointment)
-        session.commit()
+        await session.commit()
+        slot_index.invalidate(barber_id, selected_day)
+
+        if appointment_id is None:
+            # Someone else confirmed this slot first, offer what is left of the day
+            available_times = await get_available_times(session, barber_id, day, data.get("duration", SLOT_MINUTES))
+            await callback_query.answer("Бу вақт аллақачон банд қилинган.", show_alert=True)
+
+            if not available_times:
+                await state.clear()
+                return callback_query.message.answer(
+                    "Ушбу санада бу Сартарошнинг бўш вақти қолмади. Илтимос, қайтадан уриниб кўринг.",
+                    reply_markup=main_menu_button()
+                )
+
+            await state.set_state(Booking.time)
+            return callback_query.message.answer(
+                f"Ушбу санадаги: {day}. Бўш вақтлардан бирини танланг:",
+                reply_markup=time_list_button(available_times)
+            )
+
+        # Messages are sent by the notifier workers, the callback does not wait for Telegram
+        notifier.wake()
+        await state.clear()
+        return callback_query.answer()
 
     except Exception as e:
         await callback_query.answer("Хатолик юз берди. Илтимос, қайта уриниб кўринг.", show_alert=True)
@@ -329,7 +327,13 @@ async def confirm_booking(callback_query: CallbackQuery, state: FSMContext, bot:
 
 
 @inform_router.callback_query(F.data == "cancel_booking")
-async def cancel_booking(callback_query: CallbackQuery, state: FSMContext):
+async def cancel_booking(callback_query: CallbackQuery, state: FSMContext, session: AsyncSession):
+    # Band qilingan vaqtni boshqalarga qaytarish
+    released = await release_holds(session, callback_query.from_user.id)
+    await session.commit()
+    for barber_id, moment in released:
+        slot_index.invalidate(barber_id, moment.date())
+
     await callback_query.answer("Буюртма бекор қилинди.", show_alert=True)
     await state.clear()
     await callback_query.message.delete()
@@ -1,13 +1,16 @@
 import os
 
 from aiogram import Router, html, Bot
-from aiogram.filters import CommandStart
+from aiogram.filters import CommandStart, ChatMemberUpdatedFilter, KICKED, MEMBER
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message
+from aiogram.types import Message, ChatMemberUpdated
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from handlers.admin import admin_button
 from keyboards import main_menu_button
-from models import session, User
+from models import User
 
 start_router = Router()
 
@@ -52,17 +55,30 @@ start_router = Router()
 #     return ikb
 
 
+@start_router.my_chat_member(ChatMemberUpdatedFilter(member_status_changed=KICKED))
+async def user_blocked_bot(event: ChatMemberUpdated, session: AsyncSession):
+    await session.execute(update(User).filter(User.user_id == event.chat.id).values(is_blocked=True))
+    await session.commit()
+
+
+@start_router.my_chat_member(ChatMemberUpdatedFilter(member_status_changed=MEMBER))
+async def user_unblocked_bot(event: ChatMemberUpdated, session: AsyncSession):
+    await session.execute(update(User).filter(User.user_id == event.chat.id).values(is_blocked=False))
+    await session.commit()
+
+
 @start_router.message(CommandStart())
-async def command_start_handler(message: Message, state: FSMContext, bot: Bot) -> None:
+async def command_start_handler(message: Message, state: FSMContext, bot: Bot, session: AsyncSession) -> None:
     user_id = message.from_user.id
     full_name = html.bold(message.from_user.full_name)
     username = message.from_user.username
 
-    existing_user = session.query(User).filter_by(user_id=user_id).first()
-    if not existing_user:
-        new_user = User(user_id=user_id, username=username)
-        session.add(new_user)
-        session.commit()
+    # One statement, users.user_id is unique; a returning user is reachable again
+    await session.execute(insert(User).values(user_id=user_id, username=username).on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={'is_blocked': False}
+    ))
+    await session.commit()
 
     if int(message.from_user.id) == int(os.getenv('ADMIN_ID')):
         await message.answer(
@@ -0,0 +1,37 @@
+from bisect import bisect_left, bisect_right
+from typing import Iterable
+
+
+class Intervals:
+    """Disjoint half-open [start, end) intervals kept sorted by start, in minutes since midnight.
+
+    Built in O(n log n) from any pairs, overlapping or touching ones merged; every query
+    after that is a binary search.
+    """
+
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, pairs: Iterable[tuple[int, int]] = ()):
+        self.starts: list[int] = []
+        self.ends: list[int] = []
+        for start, end in sorted(pair for pair in pairs if pair[0] < pair[1]):
+            if self.ends and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def overlaps(self, start: int, end: int) -> bool:
+        # Only the last interval starting before `end` can reach into [start, end)
+        index = bisect_left(self.starts, end) - 1
+        return index >= 0 and self.ends[index] > start
+
+    def covers(self, start: int, end: int) -> bool:
+        index = bisect_right(self.starts, start) - 1
+        return index >= 0 and self.ends[index] >= end
@@ -1,56 +1,69 @@
 from aiogram.types import KeyboardButton
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from models import session, Salon, BarberService
+from catalog import catalog
 
 
 def main_menu_button():
+    return catalog.keyboard('main_menu', _main_menu_button)
+
+
+def _main_menu_button():
     rkb = ReplyKeyboardBuilder()
     rkb.add(KeyboardButton(text='Соч олдириш 💇'), KeyboardButton(text='Салонлар 💇🏻'))
     rkb.adjust(2)
     return rkb.as_markup(resize_keyboard=True)
 
 
-def salon_list_button():
+def salon_list_button(with_back=False):
+    # Built from the in-process catalog, no DB access
+    return catalog.keyboard(('salons', with_back), lambda: _salon_list_button(with_back))
+
+
+def _salon_list_button(with_back):
     rkb = ReplyKeyboardBuilder()
-    salons = session.query(Salon).all()
+    salons = catalog.salons
 
     if not salons:
         print("Датабазада салонлар топилмади.")
     else:
         print(f"Топилган {len(salons)} салон.")
 
-    for salon in salons:
-        rkb.add(KeyboardButton(text=salon.name))
+    for salon_name in salons:
+        rkb.add(KeyboardButton(text=salon_name))
+
+    if with_back:
+        rkb.add(KeyboardButton(text="Ортга"))  # Back button
 
     rkb.adjust(2)
     return rkb.as_markup(resize_keyboard=True)
 
 
-def service_list_button(barber_id):
+async def service_list_button(session: AsyncSession, barber_id):
+    return await catalog.cached(('services', barber_id), lambda: _service_list_button(session, barber_id))
+
+
+async def _service_list_button(session: AsyncSession, barber_id):
     rkb = ReplyKeyboardBuilder()
 
-    # Fetch the services related to the specified barber
-    barber_services = session.query(BarberService).filter(BarberService.barber_id == barber_id).all()
+    # The barber's service menu, shared with choose_service
+    services = await catalog.barber_services(session, barber_id)
 
     # If no barber services are found, log a message
-    if not barber_services:
+    if not services:
         print("Бу сартарошга тегишли хизматлар топилмади.")
         return None  # Return None if no services are found
 
     # Log the number of services found
-    print(f"Топилган {len(barber_services)} хизмат.")
+    print(f"Топилган {len(services)} хизмат.")
 
     # Add each service name to the reply keyboard
-    for barber_service in barber_services:
-        service = barber_service.service
-        rkb.add(KeyboardButton(text=f"{service.name}"))
+    for service_name in services:
+        rkb.add(KeyboardButton(text=service_name))
 
     # Adjust the keyboard layout (you can change the number depending on how many buttons you want per row)
     rkb.adjust(2)
 
     # Return the generated keyboard markup
     return rkb.as_markup(resize_keyboard=True)
-
-
-
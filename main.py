@@ -5,22 +5,63 @@ from os import getenv
 
 from aiogram import *
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
 from aiogram.enums import ParseMode
+from aiogram.methods import TelegramMethod
 from dotenv import load_dotenv
 
 from handlers import dp
+from middlewares import ReachabilityMiddleware, RateLimitMiddleware
+from migrations import upgrade_schema
+from models import async_session
+from scheduler import UpdateScheduler
 
 load_dotenv()
 TOKEN = getenv("BOT_TOKEN")
+BOT_API_URL = getenv("BOT_API_URL")  # Local Bot API server or a fake one for load tests
+
+
+def create_bot() -> Bot:
+    api = TelegramAPIServer.from_base(BOT_API_URL) if BOT_API_URL else PRODUCTION
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=api), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(ReachabilityMiddleware(async_session))
+    # Innermost, so a call waits for its turn (and retries a flood wait) before reaching Telegram
+    bot.session.middleware(RateLimitMiddleware())
+    return bot
+
+
+def method_payload(bot: Bot, result: TelegramMethod) -> tuple[dict, dict]:
+    """JSON body that makes Telegram execute `result` when returned as a webhook reply, and its files."""
+    files = {}
+    payload = {'method': result.__api_method__}
+    for key, value in result.model_dump(warnings=False).items():
+        value = bot.session.prepare_value(value, bot=bot, files=files, _dumps_json=False)
+        if value is not None:
+            payload[key] = value
+    return payload, files
 
 
 async def main() -> None:
-    bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot = create_bot()
+
+    # getUpdates is rejected while a webhook is set, e.g. after switching back from webhook mode
+    await bot.delete_webhook()
 
-    await dp.start_polling(bot)
+    # Chats are handled in parallel, the updates of one chat in order
+    scheduler = UpdateScheduler(dp, bot)
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    scheduler.start()
+    try:
+        await scheduler.run_polling()
+    finally:
+        await scheduler.stop()
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        await bot.session.close()
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
+    upgrade_schema()
     asyncio.run(main())
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from contextvars import ContextVar
+from os import getenv
+from typing import Optional, Sequence
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)  # SQL statements per update
+METRICS_DIR = getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'hairbot-metrics'))
+EXPORT_INTERVAL = 10  # seconds between snapshots of a bot process
+
+_started_at = int(time.time())
+_exporter: Optional[asyncio.Task] = None
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: dict[tuple, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Histogram:
+    """Observations counted per bucket, plus their sum. Buckets are not cumulative until rendered."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values: dict[tuple, list[float]] = {}  # counts per bucket, +Inf, then the sum
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        counts[index] += 1
+        counts[-1] += value
+
+
+REGISTRY: list[Counter | Histogram] = []
+
+updates = Counter('bot_updates_total', 'Updates handled, by the handler that took them', ['handler'])
+update_errors = Counter('bot_update_errors_total', 'Updates whose handling raised', ['handler'])
+update_seconds = Histogram(
+    'bot_update_seconds', 'Time to handle an update, DB session and FSM flush included', ['handler']
+)
+update_queries = Histogram('bot_update_sql_queries', 'SQL statements run for one update', ['handler'], QUERY_BUCKETS)
+update_sql_seconds = Histogram('bot_update_sql_seconds', 'Time spent in SQL for one update', ['handler'])
+update_wait_seconds = Histogram('bot_update_wait_seconds', 'Time an update waited in the scheduler before it started')
+fsm_entered = Counter('bot_fsm_entered_total', 'Chats that moved to the FSM state', ['state'])
+fsm_abandoned = Counter(
+    'bot_fsm_abandoned_total', 'FSM flows dropped after FSM_TTL without activity, by the state they stopped at',
+    ['state']
+)
+
+
+class UpdateStats:
+    __slots__ = ('handler', 'queries', 'sql_seconds', 'finished')
+
+    def __init__(self):
+        self.handler = 'unhandled'
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.finished = False  # Tasks started by the handler inherit the stats, their queries don't count
+
+
+current_update: ContextVar[Optional[UpdateStats]] = ContextVar('current_update', default=None)
+
+
+def record_update(stats: UpdateStats, seconds: float, failed: bool):
+    stats.finished = True
+    updates.inc(stats.handler)
+    if failed:
+        update_errors.inc(stats.handler)
+    update_seconds.observe(seconds, stats.handler)
+    update_queries.observe(stats.queries, stats.handler)
+    update_sql_seconds.observe(stats.sql_seconds, stats.handler)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # On the statement's own context, nothing is left behind when it raises and the after event never comes
+    if context is not None:
+        context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_started', None)
+    stats = current_update.get()
+    if started is not None and stats is not None and not stats.finished:
+        stats.queries += 1
+        stats.sql_seconds += time.perf_counter() - started
+
+
+def instrument_engine(engine: AsyncEngine):
+    """Counts the statements run on the engine towards the update being handled."""
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def snapshot() -> dict:
+    return {
+        metric.name: {
+            'kind': metric.kind,
+            'help': metric.help,
+            'labels': metric.labels,
+            'buckets': getattr(metric, 'buckets', ()),
+            'samples': [[list(labels), value] for labels, value in metric.values.items()]
+        }
+        for metric in REGISTRY
+    }
+
+
+def _snapshot_path() -> str:
+    # A restarted process gets a new file, so the totals of the old one are kept
+    return os.path.join(METRICS_DIR, f'{os.getpid()}-{_started_at}.json')
+
+
+def export():
+    """Writes this process' snapshot where collect() of any process finds it."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = _snapshot_path()
+    with open(path + '.tmp', 'w') as file:
+        json.dump(snapshot(), file)
+    os.replace(path + '.tmp', path)
+
+
+async def _export_forever(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            export()
+        except OSError as e:
+            logging.warning("Could not export metrics: %s", e)
+
+
+def start_exporter(interval=EXPORT_INTERVAL):
+    global _exporter
+    _exporter = asyncio.create_task(_export_forever(interval))
+
+
+def stop_exporter():
+    global _exporter
+    if _exporter:
+        _exporter.cancel()
+        _exporter = None
+        try:
+            export()
+        except OSError as e:
+            logging.warning("Could not export metrics: %s", e)
+
+
+def collect() -> dict:
+    """Sums the snapshots of all bot processes, this one's taken live."""
+    snapshots = {}
+    if os.path.isdir(METRICS_DIR):
+        for name in os.listdir(METRICS_DIR):
+            if name.endswith('.json'):
+                try:
+                    with open(os.path.join(METRICS_DIR, name)) as file:
+                        snapshots[name] = json.load(file)
+                except (OSError, ValueError) as e:
+                    logging.warning("Skipping metrics snapshot %s: %s", name, e)
+    snapshots[os.path.basename(_snapshot_path())] = snapshot()
+
+    merged = {}
+    for metrics in snapshots.values():
+        for name, metric in metrics.items():
+            target = merged.setdefault(name, {**metric, 'samples': {}})
+            for labels, value in metric['samples']:
+                key = tuple(labels)
+                if key not in target['samples']:
+                    target['samples'][key] = value
+                elif metric['kind'] == 'histogram':
+                    target['samples'][key] = [a + b for a, b in zip(target['samples'][key], value)]
+                else:
+                    target['samples'][key] += value
+    return merged
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Sequence, **extra) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in [*zip(names, values), *extra.items()]]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render(metrics: dict) -> str:
+    """Prometheus text exposition format."""
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append(f'# HELP {name} {metric["help"]}')
+        lines.append(f'# TYPE {name} {metric["kind"]}')
+        for labels, value in sorted(metric['samples'].items()):
+            if metric['kind'] == 'counter':
+                lines.append(f'{name}{_labels(metric["labels"], labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip([*metric['buckets'], '+Inf'], value):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(metric["labels"], labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(metric["labels"], labels)} {value[-1]}')
+            lines.append(f'{name}_count{_labels(metric["labels"], labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
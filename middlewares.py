@@ -0,0 +1,217 @@
+import logging
+import time
+from datetime import datetime
+from os import getenv
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import TelegramMethod, Response
+from aiogram.types import TelegramObject
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import metrics
+from models import User
+from profiler import profiler
+from ratelimit import TokenBucket, PriorityTokenBucket, bulk_traffic
+
+# Telegram's limits for outgoing messages
+GLOBAL_RATE = float(getenv('BOT_GLOBAL_RATE', 30))  # per second over all chats, split it between bot processes
+GLOBAL_BURST = 10
+CHAT_RATE = 1  # per second in a private chat
+CHAT_BURST = 3
+GROUP_RATE = 20 / 60  # per second in a group
+GROUP_BURST = 3
+MAX_CHAT_BUCKETS = 10_000
+MAX_RETRIES = 3
+MAX_RETRY_AFTER = 30  # seconds, longer flood waits are left to the caller
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Opens one short-lived AsyncSession per update and passes it to handlers as `session`."""
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self.session_pool = session_pool
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        async with self.session_pool() as session:
+            data['session'] = session
+            return await handler(event, data)
+
+
+class FSMFlushMiddleware(BaseMiddleware):
+    """Writes the FSM changes buffered by SQLAlchemyStorage once the update is handled."""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        try:
+            return await handler(event, data)
+        finally:
+            state = data.get('state')
+            if state is not None:
+                await self.storage.flush(state.key)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Records the latency, outcome and SQL statements of every update under its handler's name.
+
+    The outermost update middleware, so the time includes the DB session and the FSM flush.
+    HandlerNameMiddleware fills in the name; updates no handler took count as "unhandled".
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        stats = metrics.UpdateStats()
+        token = metrics.current_update.set(stats)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await handler(event, data)
+            failed = False
+            return result
+        finally:
+            metrics.current_update.reset(token)
+            metrics.record_update(stats, time.perf_counter() - started, failed)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Tells MetricsMiddleware which handler took the update; an inner middleware, it runs after the filters."""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        stats = metrics.current_update.get()
+        if stats is not None:
+            stats.handler = data['handler'].callback.__name__
+        return await handler(event, data)
+
+
+class ProfilerMiddleware(BaseMiddleware):
+    """Runs the handler of sampled updates under cProfile, see profiler.py; a flag check while it's off."""
+
+    async def __call__(
+            self,
+            handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+            event: TelegramObject,
+            data: Dict[str, Any]
+    ) -> Any:
+        name = data['handler'].callback.__name__
+        if not profiler.wants(name):
+            return await handler(event, data)
+        return await profiler.profile(name, handler(event, data))
+
+
+async def set_user_reachability(session_pool: async_sessionmaker, chat_id: int, is_blocked: bool):
+    values = {'is_blocked': is_blocked}
+    if is_blocked:
+        values['last_error_at'] = datetime.now()
+    async with session_pool() as session:
+        await session.execute(update(User).filter(User.user_id == chat_id).values(**values))
+        await session.commit()
+
+
+class ReachabilityMiddleware(BaseRequestMiddleware):
+    """Marks users as blocked when any Bot API call to their chat fails because the chat is gone."""
+
+    def __init__(self, session_pool: async_sessionmaker):
+        self.session_pool = session_pool
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType,
+            bot: Bot,
+            method: TelegramMethod
+    ) -> Response:
+        try:
+            return await make_request(bot, method)
+        except TelegramForbiddenError:
+            await self._mark_blocked(method)
+            raise
+        except TelegramBadRequest as e:
+            if "chat not found" in e.message:
+                await self._mark_blocked(method)
+            raise
+
+    async def _mark_blocked(self, method: TelegramMethod):
+        chat_id = getattr(method, 'chat_id', None)
+        if not isinstance(chat_id, int):
+            return
+        try:
+            await set_user_reachability(self.session_pool, chat_id, True)
+        except Exception as e:
+            logging.warning("Could not mark chat %s as blocked: %s", chat_id, e)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Keeps outgoing Bot API calls within Telegram's global and per-chat limits.
+
+    A call addressed to a chat takes a token from that chat's bucket and then from the
+    global one, where replies to users go before bulk traffic (see ratelimit.bulk_traffic).
+    Calls without a chat (getUpdates, answerCallbackQuery, ...) pass straight through.
+    A `retry_after` pauses the chat and the call is repeated, so callers only see
+    TelegramRetryAfter when Telegram keeps refusing or asks for a long wait.
+    """
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, group_rate=GROUP_RATE,
+                 max_retries=MAX_RETRIES):
+        self.global_bucket = PriorityTokenBucket(global_rate, GLOBAL_BURST)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chats: Dict[Any, TokenBucket] = {}
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                # A refilled bucket is the same as a new one, so idle chats can be forgotten
+                self._chats = {key: value for key, value in self._chats.items() if not value.full()}
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.chat_rate, CHAT_BURST)
+            else:
+                bucket = TokenBucket(self.group_rate, GROUP_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def __call__(
+            self,
+            make_request: NextRequestMiddlewareType,
+            bot: Bot,
+            method: TelegramMethod
+    ) -> Response:
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        chat_bucket = self.chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await chat_bucket.acquire()
+            await self.global_bucket.acquire(bulk=bulk_traffic.get())
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries or e.retry_after > MAX_RETRY_AFTER:
+                    raise
+                logging.info("Flood wait of %s s for chat %s", e.retry_after, chat_id)
+                chat_bucket.pause(e.retry_after)
@@ -0,0 +1,9 @@
+from pathlib import Path
+
+from alembic import command
+from alembic.config import Config
+
+
+def upgrade_schema():
+    """Applies pending migrations from migrations/versions."""
+    command.upgrade(Config(str(Path(__file__).parent.parent / 'alembic.ini')), 'head')
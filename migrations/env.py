@@ -0,0 +1,19 @@
+from alembic import context
+from sqlalchemy import text
+
+from models import Base, engine
+
+# Bot workers may start at the same time, the lock makes the others wait and then see the new head
+MIGRATION_LOCK = 727001
+
+
+def run_migrations_online():
+    with engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=Base.metadata)
+
+        with context.begin_transaction():
+            connection.execute(text(f'SELECT pg_advisory_xact_lock({MIGRATION_LOCK})'))
+            context.run_migrations()
+
+
+run_migrations_online()
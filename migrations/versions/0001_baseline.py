@@ -0,0 +1,125 @@
+"""baseline schema
+
+Tables that used to be created by Base.metadata.create_all at import. Every
+step is idempotent so databases created that way can be upgraded in place.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'users',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('user_id', sa.BIGINT(), nullable=False),
+        sa.Column('username', sa.VARCHAR(255), nullable=True),
+        sa.Column('name', sa.String(), nullable=True),
+        sa.Column('phone', sa.String(), nullable=True),
+        if_not_exists=True,
+    )
+    # Added after the tables were first created
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN NOT NULL DEFAULT false")
+    op.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_error_at TIMESTAMP WITHOUT TIME ZONE")
+    op.create_index('ix_users_reachable', 'users', ['id'], postgresql_where=sa.text('NOT is_blocked'),
+                    if_not_exists=True)
+
+    op.create_table(
+        'salons',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('name', sa.String(), nullable=False, unique=True),
+        sa.Column('phone', sa.String(), nullable=True),
+        sa.Column('latitude', sa.Float(), nullable=False),
+        sa.Column('longtitude', sa.Float(), nullable=False),
+        if_not_exists=True,
+    )
+    op.create_table(
+        'services',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('salon_id', sa.Integer(), sa.ForeignKey('salons.id'), nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('description', sa.String(), nullable=True),
+        sa.Column('price', sa.Float(), nullable=False),
+        if_not_exists=True,
+    )
+    op.create_table(
+        'barbers',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('salon_id', sa.Integer(), sa.ForeignKey('salons.id'), nullable=False),
+        sa.Column('user_id', sa.BIGINT(), nullable=False),
+        if_not_exists=True,
+    )
+    op.create_table(
+        'barber_availabilities',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('barber_id', sa.Integer(), sa.ForeignKey('barbers.id'), nullable=False),
+        sa.Column('available_date', sa.DateTime(), nullable=False),
+        sa.Column('free_time', sa.Time(), nullable=False),
+        if_not_exists=True,
+    )
+    op.create_table(
+        'barber_services',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('barber_id', sa.Integer(), sa.ForeignKey('barbers.id'), nullable=False),
+        sa.Column('service_id', sa.Integer(), sa.ForeignKey('services.id'), nullable=False),
+        if_not_exists=True,
+    )
+    op.create_table(
+        'appointments',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('user_id', sa.Integer(), sa.ForeignKey('users.id'), nullable=False),
+        sa.Column('salon_id', sa.Integer(), sa.ForeignKey('salons.id'), nullable=False),
+        sa.Column('barber_id', sa.Integer(), sa.ForeignKey('barbers.id'), nullable=False),
+        sa.Column('time', sa.DateTime(), nullable=False),
+        sa.Column('name', sa.String(), nullable=False),
+        sa.Column('phone', sa.String(), nullable=False),
+        sa.Column('service_id', sa.Integer(), sa.ForeignKey('services.id'), nullable=False),
+        if_not_exists=True,
+    )
+    op.create_table(
+        'broadcasts',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('admin_chat_id', sa.BIGINT(), nullable=False),
+        sa.Column('progress_message_id', sa.Integer(), nullable=True),
+        sa.Column('photo', sa.String(), nullable=False),
+        sa.Column('caption', sa.String(), nullable=True),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('last_user_id', sa.Integer(), nullable=False),
+        sa.Column('delivered', sa.Integer(), nullable=False),
+        sa.Column('failed', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        if_not_exists=True,
+    )
+    op.create_table(
+        'fsm_states',
+        sa.Column('key', sa.String(), primary_key=True),
+        sa.Column('state', sa.String(), nullable=True),
+        sa.Column('data', sa.Text(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        if_not_exists=True,
+    )
+    op.create_index('ix_fsm_states_updated_at', 'fsm_states', ['updated_at'], if_not_exists=True)
+
+    op.create_table(
+        'catalog_versions',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('version', sa.BIGINT(), nullable=False),
+        if_not_exists=True,
+    )
+    op.execute("INSERT INTO catalog_versions (id, version) VALUES (1, 0) ON CONFLICT DO NOTHING")
+
+
+def downgrade() -> None:
+    for table in ('catalog_versions', 'fsm_states', 'broadcasts', 'appointments', 'barber_services',
+                  'barber_availabilities', 'barbers', 'services', 'salons', 'users'):
+        op.drop_table(table)
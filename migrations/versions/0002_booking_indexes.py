@@ -0,0 +1,45 @@
+"""indexes and unique constraints for the booking hot queries
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # /start used to race and insert the same Telegram user twice, keep the oldest row
+    op.execute("""
+        UPDATE appointments a SET user_id = d.keep_id
+        FROM (SELECT id, min(id) OVER (PARTITION BY user_id) AS keep_id FROM users) d
+        WHERE a.user_id = d.id AND d.id <> d.keep_id
+    """)
+    op.execute("DELETE FROM users u USING users k WHERE u.user_id = k.user_id AND u.id > k.id")
+    op.create_unique_constraint('uq_users_user_id', 'users', ['user_id'])
+
+    op.execute("""
+        DELETE FROM barber_services a USING barber_services b
+        WHERE a.barber_id = b.barber_id AND a.service_id = b.service_id AND a.id > b.id
+    """)
+    op.create_unique_constraint('uq_barber_services_barber_service', 'barber_services', ['barber_id', 'service_id'])
+
+    op.create_index('ix_appointments_barber_time', 'appointments', ['barber_id', 'time'])
+    op.create_index('ix_barber_availabilities_barber_date', 'barber_availabilities', ['barber_id', 'available_date'])
+    op.create_index('ix_barbers_salon_id', 'barbers', ['salon_id'])
+    op.create_index('ix_barbers_name', 'barbers', ['name'])
+    op.create_index('ix_services_salon_id', 'services', ['salon_id'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_services_salon_id', 'services')
+    op.drop_index('ix_barbers_name', 'barbers')
+    op.drop_index('ix_barbers_salon_id', 'barbers')
+    op.drop_index('ix_barber_availabilities_barber_date', 'barber_availabilities')
+    op.drop_index('ix_appointments_barber_time', 'appointments')
+    op.drop_constraint('uq_barber_services_barber_service', 'barber_services')
+    op.drop_constraint('uq_users_user_id', 'users')
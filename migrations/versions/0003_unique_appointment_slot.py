@@ -0,0 +1,27 @@
+"""one appointment per barber and start time
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Double bookings made before the constraint existed, the first booking keeps the slot
+    op.execute("""
+        DELETE FROM appointments a USING appointments b
+        WHERE a.barber_id = b.barber_id AND a.time = b.time AND a.id > b.id
+    """)
+    op.drop_index('ix_appointments_barber_time', 'appointments')
+    op.create_unique_constraint('uq_appointments_barber_time', 'appointments', ['barber_id', 'time'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_appointments_barber_time', 'appointments')
+    op.create_index('ix_appointments_barber_time', 'appointments', ['barber_id', 'time'])
@@ -0,0 +1,31 @@
+"""slot holds taken while a booking is being filled in
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'slot_holds',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('barber_id', sa.Integer(), sa.ForeignKey('barbers.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('time', sa.DateTime(), nullable=False),
+        sa.Column('chat_id', sa.BIGINT(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.UniqueConstraint('barber_id', 'time', name='uq_slot_holds_barber_time'),
+    )
+    op.create_index('ix_slot_holds_chat_id', 'slot_holds', ['chat_id'])
+    op.create_index('ix_slot_holds_expires_at', 'slot_holds', ['expires_at'])
+
+
+def downgrade() -> None:
+    op.drop_table('slot_holds')
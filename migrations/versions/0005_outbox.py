@@ -0,0 +1,32 @@
+"""outbox of booking notifications
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'outbox',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('chat_id', sa.BIGINT(), nullable=False),
+        sa.Column('body', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False, server_default='pending'),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default=sa.text('0')),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=False),
+        sa.Column('last_error', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+    )
+    op.create_index('ix_outbox_pending', 'outbox', ['next_attempt_at'], postgresql_where=sa.text("status = 'pending'"))
+
+
+def downgrade() -> None:
+    op.drop_table('outbox')
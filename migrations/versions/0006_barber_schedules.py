@@ -0,0 +1,35 @@
+"""barber schedules as one quarter-hour bitmap per barber and day
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'barber_schedules',
+        sa.Column('barber_id', sa.Integer(), sa.ForeignKey('barbers.id', ondelete='CASCADE'), primary_key=True),
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('slots', postgresql.BIT(96), nullable=False),
+    )
+    # Bit n of a day is its n-th quarter hour, free times between quarters fall into the earlier one
+    op.execute("""
+        INSERT INTO barber_schedules (barber_id, day, slots)
+        SELECT barber_id, CAST(available_date AS date),
+               bit_or(CAST('1' AS bit(96)) >> (CAST(extract(epoch FROM free_time) AS integer) / 900))
+        FROM barber_availabilities
+        GROUP BY barber_id, CAST(available_date AS date)
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('barber_schedules')
@@ -0,0 +1,45 @@
+"""weekly schedule templates and their exceptions
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'schedule_templates',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('barber_id', sa.Integer(), sa.ForeignKey('barbers.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('weekday', sa.Integer(), nullable=False),
+        sa.Column('start_time', sa.Time(), nullable=False),
+        sa.Column('end_time', sa.Time(), nullable=False),
+        sa.Column('slot_minutes', sa.Integer(), nullable=False, server_default=sa.text('30')),
+        sa.CheckConstraint('weekday BETWEEN 0 AND 6', name='ck_schedule_templates_weekday'),
+        sa.CheckConstraint('slot_minutes > 0', name='ck_schedule_templates_slot_minutes'),
+    )
+    op.create_index('ix_schedule_templates_barber_id', 'schedule_templates', ['barber_id'])
+
+    op.create_table(
+        'schedule_exceptions',
+        sa.Column('id', sa.Integer(), primary_key=True, autoincrement=True),
+        sa.Column('barber_id', sa.Integer(), sa.ForeignKey('barbers.id', ondelete='CASCADE'), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('start_time', sa.Time(), nullable=True),
+        sa.Column('end_time', sa.Time(), nullable=True),
+        sa.Column('slot_minutes', sa.Integer(), nullable=False, server_default=sa.text('30')),
+        sa.CheckConstraint('slot_minutes > 0', name='ck_schedule_exceptions_slot_minutes'),
+    )
+    op.create_index('ix_schedule_exceptions_barber_day', 'schedule_exceptions', ['barber_id', 'day'])
+
+
+def downgrade() -> None:
+    op.drop_table('schedule_exceptions')
+    op.drop_table('schedule_templates')
@@ -0,0 +1,52 @@
+"""service durations, appointment and hold end times, no overlapping appointments
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('services', sa.Column('duration_minutes', sa.Integer(), nullable=False, server_default=sa.text('30')))
+    op.create_check_constraint('ck_services_duration_minutes', 'services', 'duration_minutes BETWEEN 1 AND 1440')
+
+    # Existing bookings are cut short where the next one of the barber starts, so none of them overlap
+    op.add_column('appointments', sa.Column('end_time', sa.DateTime(), nullable=True))
+    op.execute("""
+        UPDATE appointments a SET end_time = least(
+            a.time + make_interval(mins => s.duration_minutes),
+            coalesce(n.next_time, 'infinity')
+        )
+        FROM services s, (
+            SELECT id, lead(time) OVER (PARTITION BY barber_id ORDER BY time) AS next_time FROM appointments
+        ) n
+        WHERE s.id = a.service_id AND n.id = a.id
+    """)
+    op.alter_column('appointments', 'end_time', nullable=False)
+
+    op.add_column('slot_holds', sa.Column('end_time', sa.DateTime(), nullable=True))
+    op.execute("UPDATE slot_holds SET end_time = time + interval '30 minutes'")
+    op.alter_column('slot_holds', 'end_time', nullable=False)
+
+    # The models.barber_span expression: one int8range per barber and booking, no btree_gist needed
+    op.execute("""
+        ALTER TABLE appointments ADD CONSTRAINT ex_appointments_barber_overlap EXCLUDE USING gist (int8range(
+            CAST(barber_id AS BIGINT) * 10000000000 + CAST(EXTRACT(epoch FROM time) AS BIGINT),
+            CAST(barber_id AS BIGINT) * 10000000000 + CAST(EXTRACT(epoch FROM end_time) AS BIGINT)
+        ) WITH &&)
+    """)
+
+
+def downgrade() -> None:
+    op.drop_constraint('ex_appointments_barber_overlap', 'appointments')
+    op.drop_column('slot_holds', 'end_time')
+    op.drop_column('appointments', 'end_time')
+    op.drop_constraint('ck_services_duration_minutes', 'services')
+    op.drop_column('services', 'duration_minutes')
@@ -1,15 +1,42 @@
-from datetime import datetime
-from sqlalchemy import create_engine, Integer, String, ForeignKey, DateTime, BIGINT, VARCHAR, Time, Float
-from sqlalchemy.orm import Mapped, mapped_column, relationship, declarative_base, Session
+from datetime import datetime, date, time, timedelta
+from os import getenv
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, Integer, String, ForeignKey, DateTime, BIGINT, VARCHAR, Time, Float, Boolean, \
+    Index, Text, false, text, event, update, UniqueConstraint, Date, cast, func, literal, delete, inspect, select, \
+    CheckConstraint, literal_column, extract
+from sqlalchemy.dialects.postgresql import BIT, insert, ExcludeConstraint
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Mapped, mapped_column, relationship, declarative_base
+
+load_dotenv()
+DB_URL = getenv('DB_URL', 'postgres:1@localhost:5449/hair_bot')
+SLOT_MINUTES = 15  # Resolution of BarberSchedule, free times are rounded down to it
+DAY_SLOTS = 24 * 60 // SLOT_MINUTES
+MAX_SERVICE_MINUTES = 24 * 60  # Also how far back a query looks for appointments still running
+SPAN_STRIDE = 10 ** 10  # seconds, more than any epoch a booking reaches
 
 # Database connection setup
-engine = create_engine(f'postgresql+psycopg2://postgres:1@localhost:5449/hair_bot')
-session = Session(bind=engine)
+# Sync engine is used by the starlette-admin panel, the bot works through the async one
+engine = create_engine(f'postgresql+psycopg2://{DB_URL}')
+async_engine = create_async_engine(f'postgresql+asyncpg://{DB_URL}', pool_size=10, max_overflow=20)
+async_session = async_sessionmaker(async_engine, expire_on_commit=False)
 
 # Base class definition
 Base = declarative_base()
 
 
+def barber_span(barber_id, start, end):
+    """[start, end) of a barber as an int8range of epoch seconds, every barber on a stretch of his own.
+
+    Spans overlap only for the same barber at overlapping times. Unlike barber_id WITH = next
+    to a tsrange, a single range needs no btree_gist extension in an exclusion constraint.
+    Queries must use this very expression to be answered by the index behind it.
+    """
+    offset = cast(barber_id, BIGINT) * literal_column(str(SPAN_STRIDE))
+    return func.int8range(offset + cast(extract('epoch', start), BIGINT), offset + cast(extract('epoch', end), BIGINT))
+
+
 # User Model
 class User(Base):
     __tablename__ = 'users'
@@ -20,10 +47,18 @@ class User(Base):
     username: Mapped[str] = mapped_column(VARCHAR(255), nullable=True)
     name: Mapped[str] = mapped_column(String, nullable=True)
     phone: Mapped[str] = mapped_column(String, nullable=True)
+    is_blocked: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False, server_default=false())
+    last_error_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)  # Last failed send to this chat
 
     # Relationships
     appointments: Mapped[list['Appointment']] = relationship("Appointment", back_populates="user")
 
+    __table_args__ = (
+        UniqueConstraint('user_id', name='uq_users_user_id'),
+        # Broadcasts walk reachable users by id
+        Index('ix_users_reachable', 'id', postgresql_where=text('NOT is_blocked')),
+    )
+
 
 # Salon Model
 class Salon(Base):
@@ -52,10 +87,16 @@ class Service(Base):
     name: Mapped[str] = mapped_column(String, nullable=False)
     description: Mapped[str] = mapped_column(String, nullable=True)
     price: Mapped[Float] = mapped_column(Float, nullable=False)
+    duration_minutes: Mapped[int] = mapped_column(Integer, nullable=False, default=30, server_default=text('30'))
 
     # Relationships
     salon: Mapped['Salon'] = relationship("Salon", back_populates="services")
 
+    __table_args__ = (
+        Index('ix_services_salon_id', 'salon_id'),
+        CheckConstraint(f'duration_minutes BETWEEN 1 AND {MAX_SERVICE_MINUTES}', name='ck_services_duration_minutes'),
+    )
+
 
 # Barber Model
 class Barber(Base):
@@ -72,6 +113,11 @@ class Barber(Base):
     availabilities: Mapped[list['BarberAvailability']] = relationship("BarberAvailability", back_populates="barber")
     services: Mapped[list['BarberService']] = relationship("BarberService", back_populates="barber")
 
+    __table_args__ = (
+        Index('ix_barbers_salon_id', 'salon_id'),
+        Index('ix_barbers_name', 'name'),
+    )
+
 
 class BarberAvailability(Base):
     __tablename__ = 'barber_availabilities'
@@ -85,6 +131,63 @@ class BarberAvailability(Base):
     # Relationships
     barber: Mapped['Barber'] = relationship("Barber", back_populates="availabilities")
 
+    __table_args__ = (
+        Index('ix_barber_availabilities_barber_date', 'barber_id', 'available_date'),
+    )
+
+
+# BarberSchedule Model (the BarberAvailability rows of one barber and day as a bitmap, kept in sync by mapper events)
+class BarberSchedule(Base):
+    __tablename__ = 'barber_schedules'
+
+    # Columns
+    barber_id: Mapped[int] = mapped_column(Integer, ForeignKey('barbers.id', ondelete='CASCADE'), primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    slots: Mapped[str] = mapped_column(BIT(DAY_SLOTS), nullable=False)  # Bit n is the n-th quarter hour of the day
+
+
+# ScheduleTemplate Model (recurring working hours of a barber on one weekday, expanded by availability.WeekSchedules)
+class ScheduleTemplate(Base):
+    __tablename__ = 'schedule_templates'
+
+    # Columns
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    barber_id: Mapped[int] = mapped_column(Integer, ForeignKey('barbers.id', ondelete='CASCADE'), nullable=False)
+    weekday: Mapped[int] = mapped_column(Integer, nullable=False)  # 0 is Monday
+    start_time: Mapped[time] = mapped_column(Time, nullable=False)
+    end_time: Mapped[time] = mapped_column(Time, nullable=False)  # The last slot starts before it
+    slot_minutes: Mapped[int] = mapped_column(Integer, nullable=False, default=30, server_default=text('30'))
+
+    # Relationships
+    barber: Mapped['Barber'] = relationship("Barber")
+
+    __table_args__ = (
+        CheckConstraint('weekday BETWEEN 0 AND 6', name='ck_schedule_templates_weekday'),
+        CheckConstraint('slot_minutes > 0', name='ck_schedule_templates_slot_minutes'),
+        Index('ix_schedule_templates_barber_id', 'barber_id'),
+    )
+
+
+# ScheduleException Model (a day that differs from the templates: a day off without times, other hours with them)
+class ScheduleException(Base):
+    __tablename__ = 'schedule_exceptions'
+
+    # Columns
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    barber_id: Mapped[int] = mapped_column(Integer, ForeignKey('barbers.id', ondelete='CASCADE'), nullable=False)
+    day: Mapped[date] = mapped_column(Date, nullable=False)
+    start_time: Mapped[time] = mapped_column(Time, nullable=True)
+    end_time: Mapped[time] = mapped_column(Time, nullable=True)
+    slot_minutes: Mapped[int] = mapped_column(Integer, nullable=False, default=30, server_default=text('30'))
+
+    # Relationships
+    barber: Mapped['Barber'] = relationship("Barber")
+
+    __table_args__ = (
+        CheckConstraint('slot_minutes > 0', name='ck_schedule_exceptions_slot_minutes'),
+        Index('ix_schedule_exceptions_barber_day', 'barber_id', 'day'),
+    )
+
 
 # BarberService Model (linking services to barbers)
 class BarberService(Base):
@@ -99,6 +202,11 @@ class BarberService(Base):
     barber: Mapped['Barber'] = relationship("Barber", back_populates="services")
     service: Mapped['Service'] = relationship("Service")
 
+    __table_args__ = (
+        # Also serves lookups by barber_id alone
+        UniqueConstraint('barber_id', 'service_id', name='uq_barber_services_barber_service'),
+    )
+
 
 # Appointment Model (Order)
 class Appointment(Base):
@@ -110,6 +218,7 @@ class Appointment(Base):
     salon_id: Mapped[int] = mapped_column(Integer, ForeignKey('salons.id'), nullable=False)
     barber_id: Mapped[int] = mapped_column(Integer, ForeignKey('barbers.id'), nullable=False)
     time: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    end_time: Mapped[datetime] = mapped_column(DateTime, nullable=False)  # time plus the service duration at booking
     name: Mapped[str] = mapped_column(String, nullable=False)
     phone: Mapped[str] = mapped_column(String, nullable=False)
     service_id: Mapped[int] = mapped_column(Integer, ForeignKey('services.id'),
@@ -121,6 +230,158 @@ class Appointment(Base):
     barber: Mapped['Barber'] = relationship("Barber", back_populates="appointments")
     service: Mapped['Service'] = relationship("Service")  # The service selected for the appointment
 
+    __table_args__ = (
+        # A slot can be reserved only once, see booking.reserve_slot
+        UniqueConstraint('barber_id', 'time', name='uq_appointments_barber_time'),
+        # Nor can anything overlap it; the GiST index behind this also answers the overlap checks
+        ExcludeConstraint(
+            (barber_span(literal_column('barber_id'), literal_column('time'), literal_column('end_time')), '&&'),
+            name='ex_appointments_barber_overlap', using='gist'
+        ),
+    )
+
+
+# SlotHold Model (short-lived reservation of a slot while its chat finishes the booking)
+class SlotHold(Base):
+    __tablename__ = 'slot_holds'
+
+    # Columns
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    barber_id: Mapped[int] = mapped_column(Integer, ForeignKey('barbers.id', ondelete='CASCADE'), nullable=False)
+    time: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    end_time: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    chat_id: Mapped[int] = mapped_column(BIGINT, nullable=False)  # Telegram id of the holder
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('barber_id', 'time', name='uq_slot_holds_barber_time'),
+        Index('ix_slot_holds_chat_id', 'chat_id'),
+        Index('ix_slot_holds_expires_at', 'expires_at'),
+    )
+
+
+# OutboxMessage Model (notification written with the booking, sent later by notifier.Notifier)
+class OutboxMessage(Base):
+    __tablename__ = 'outbox'
+
+    # Columns
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    chat_id: Mapped[int] = mapped_column(BIGINT, nullable=False)
+    body: Mapped[str] = mapped_column(Text, nullable=False)
+    status: Mapped[str] = mapped_column(String, nullable=False, default='pending',
+                                        server_default='pending')  # pending / failed, sent rows are deleted
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default=text('0'))
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)  # Also the lease of a claimed row
+    last_error: Mapped[str] = mapped_column(String, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_outbox_pending', 'next_attempt_at', postgresql_where=text("status = 'pending'")),
+    )
+
+
+# Broadcast Model (ad campaign sent to all users, resumable after restart)
+class Broadcast(Base):
+    __tablename__ = 'broadcasts'
+
+    # Columns
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    admin_chat_id: Mapped[int] = mapped_column(BIGINT, nullable=False)
+    progress_message_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    photo: Mapped[str] = mapped_column(String, nullable=False)
+    caption: Mapped[str] = mapped_column(String, nullable=True)
+    status: Mapped[str] = mapped_column(String, nullable=False, default='running')  # running / done
+    last_user_id: Mapped[int] = mapped_column(Integer, nullable=False, default=0)  # Cursor over users.id
+    delivered: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    failed: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.now)
+    finished_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+
+# FSMRecord Model (persistent aiogram FSM state and data, one row per chat/user key)
+class FSMRecord(Base):
+    __tablename__ = 'fsm_states'
+
+    # Columns
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    state: Mapped[str] = mapped_column(String, nullable=True)
+    data: Mapped[str] = mapped_column(Text, nullable=True)  # Compact JSON
+    updated_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_fsm_states_updated_at', 'updated_at'),
+    )
+
+
+# CatalogVersion Model (single row, bumped whenever salons, barbers or services change)
+class CatalogVersion(Base):
+    __tablename__ = 'catalog_versions'
+
+    # Columns
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    version: Mapped[int] = mapped_column(BIGINT, nullable=False, default=0)
+
+
+def bump_catalog_version(mapper, connection, target):
+    # Runs in the same transaction as the change, from the bot and from the admin panel alike
+    connection.execute(update(CatalogVersion).values(version=CatalogVersion.version + 1))
+
+
+def set_appointment_end(mapper, connection, target):
+    # Appointments made in the admin panel give only the start, a changed start or service moves the end
+    history = inspect(target).attrs
+    if target.end_time is None or (not history.end_time.history.added and (
+            history.time.history.added or history.service_id.history.added)):
+        duration = connection.scalar(select(Service.duration_minutes).filter(Service.id == target.service_id))
+        target.end_time = target.time + timedelta(minutes=duration or SLOT_MINUTES)
+
+
+event.listen(Appointment, 'before_insert', set_appointment_end)
+event.listen(Appointment, 'before_update', set_appointment_end)
+
+# Schedules too, so that the bots drop the weeks they expanded from them
+for catalog_model in (Salon, Barber, Service, BarberService, ScheduleTemplate, ScheduleException):
+    for catalog_event in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(catalog_model, catalog_event, bump_catalog_version)
+
+
+def slot_bit(moment):
+    """BIT(DAY_SLOTS) with only the bit of the slot of `moment`, a time or timestamp expression, set."""
+    quarter = cast(func.extract('epoch', cast(moment, Time)), Integer) // (SLOT_MINUTES * 60)
+    return cast(literal('1'), BIT(DAY_SLOTS)).op('>>')(quarter)
+
+
+def rebuild_schedules(*criteria):
+    """Upserts the BarberSchedule of every barber and day that has BarberAvailability rows matching criteria."""
+    day = cast(BarberAvailability.available_date, Date)
+    rows = select(
+        BarberAvailability.barber_id, day, func.bit_or(slot_bit(BarberAvailability.free_time))
+    ).filter(*criteria).group_by(BarberAvailability.barber_id, day)
+    statement = insert(BarberSchedule).from_select(['barber_id', 'day', 'slots'], rows)
+    return statement.on_conflict_do_update(
+        index_elements=[BarberSchedule.barber_id, BarberSchedule.day],
+        set_={'slots': statement.excluded.slots}
+    )
+
+
+def sync_barber_schedule(mapper, connection, target):
+    # Admin panel edits go through the ORM too; an edited row may also leave its old barber and day
+    history = inspect(target).attrs
+    days = set()
+    for barber_id in history.barber_id.history.deleted or [target.barber_id]:
+        for moment in history.available_date.history.deleted or [target.available_date]:
+            days.add((barber_id, moment.date()))
+    days.add((target.barber_id, target.available_date.date()))
+
+    for barber_id, day in days:
+        day_start = datetime.combine(day, time.min)
+        connection.execute(delete(BarberSchedule).where(BarberSchedule.barber_id == barber_id, BarberSchedule.day == day))
+        connection.execute(rebuild_schedules(
+            BarberAvailability.barber_id == barber_id,
+            BarberAvailability.available_date >= day_start,
+            BarberAvailability.available_date < day_start + timedelta(days=1)
+        ))
+
 
-# Create all tables in the database
-Base.metadata.create_all(engine)
+for availability_event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(BarberAvailability, availability_event, sync_barber_schedule)
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramAPIError
+from sqlalchemy import select, update, delete, and_, exists, func
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import aliased
+
+from models import OutboxMessage
+
+WORKERS = 4
+BATCH_SIZE = 50  # chats per claim, with all their due messages
+POLL_INTERVAL = 1  # seconds, how often idle workers look for due rows
+LEASE = timedelta(seconds=60)  # A claimed row is retried after this if its worker died mid-batch
+MAX_ATTEMPTS = 5
+BACKOFF = 2  # seconds before the first retry, doubled after every failed attempt
+LOCK_NAMESPACE = 2  # First key of the pg advisory lock taken per chat while claiming, broadcast.py uses 1
+
+
+class Outcome(NamedTuple):
+    message_id: int
+    attempted: bool
+    error: Optional[str] = None
+    retry_in: Optional[float] = None  # None for permanent failures
+
+
+class Notifier:
+    """Sends the messages that booking.reserve_slot wrote to the outbox.
+
+    Each worker claims a batch of due rows with FOR UPDATE SKIP LOCKED and pushes their
+    next_attempt_at forward by LEASE, so the workers of all bot processes share the table
+    without sending anything twice. A claim takes whole chats: all due rows of a chat, under
+    an advisory lock of the chat, and none while an older row of it is leased or waiting
+    for its retry. So messages of one chat are sent in order, different chats concurrently.
+    Sent rows are deleted, failed ones retried with exponential backoff and given up on
+    (status 'failed') after MAX_ATTEMPTS or when the chat is gone.
+    """
+
+    def __init__(self, workers=WORKERS, batch_size=BATCH_SIZE):
+        self.workers = workers
+        self.batch_size = batch_size
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def wake(self):
+        """Lets idle workers pick up a just committed message without waiting for the next poll."""
+        self._wakeup.set()
+
+    async def start(self, bot: Bot, session_pool: async_sessionmaker, interval=POLL_INTERVAL):
+        self._tasks = [asyncio.create_task(self._work(bot, session_pool, interval)) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _work(self, bot: Bot, session_pool: async_sessionmaker, interval):
+        while True:
+            self._wakeup.clear()
+            try:
+                claimed = await self.drain_batch(bot, session_pool)
+            except Exception as e:
+                logging.warning("Outbox batch failed: %s", e)
+                claimed = 0
+
+            if not claimed:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def drain_batch(self, bot: Bot, session_pool: async_sessionmaker) -> int:
+        """Claims, sends and settles one batch of due messages, returns how many were claimed."""
+        now = datetime.now()
+        is_due = and_(OutboxMessage.status == 'pending', OutboxMessage.next_attempt_at <= now)
+        chats = select(OutboxMessage.chat_id).filter(is_due).group_by(OutboxMessage.chat_id).order_by(
+            func.min(OutboxMessage.id)
+        ).limit(self.batch_size)
+        older = aliased(OutboxMessage)
+        due = select(OutboxMessage.id).filter(
+            is_due,
+            OutboxMessage.chat_id.in_(chats.scalar_subquery()),
+            # Held until the claim commits, another worker skips the chat meanwhile and its leased rows after
+            func.pg_try_advisory_xact_lock(LOCK_NAMESPACE, func.hashint8(OutboxMessage.chat_id)),
+            ~exists().where(
+                older.chat_id == OutboxMessage.chat_id,
+                older.id < OutboxMessage.id,
+                older.status == 'pending',
+                older.next_attempt_at > now
+            )
+        ).with_for_update(skip_locked=True)
+
+        async with session_pool() as session:
+            messages = (await session.execute(
+                update(OutboxMessage).where(OutboxMessage.id.in_(due.scalar_subquery())).values(
+                    next_attempt_at=now + LEASE
+                ).returning(
+                    OutboxMessage.id, OutboxMessage.chat_id, OutboxMessage.body, OutboxMessage.attempts
+                ).execution_options(synchronize_session=False)
+            )).all()
+            await session.commit()
+
+        if not messages:
+            return 0
+
+        chats: dict[int, list] = {}
+        for message in sorted(messages, key=lambda message: message.id):
+            chats.setdefault(message.chat_id, []).append(message)
+        outcomes = [outcome for chat_outcomes in await asyncio.gather(
+            *(self._send_chat(bot, chat_messages) for chat_messages in chats.values())
+        ) for outcome in chat_outcomes]
+
+        await self._settle(session_pool, {message.id: message.attempts for message in messages}, outcomes)
+        return len(messages)
+
+    async def _send_chat(self, bot: Bot, messages: list) -> list[Outcome]:
+        outcomes = []
+        for index, message in enumerate(messages):
+            try:
+                await bot.send_message(message.chat_id, message.body)
+                outcomes.append(Outcome(message.id, True))
+                continue
+            except TelegramRetryAfter as e:
+                outcome = Outcome(message.id, True, str(e), e.retry_after)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Blocked bot or deleted chat, ReachabilityMiddleware has already marked the user
+                outcome = Outcome(message.id, True, str(e))
+            except TelegramAPIError as e:
+                outcome = Outcome(message.id, True, str(e), BACKOFF * 2 ** message.attempts)
+
+            outcomes.append(outcome)
+            # The rest of the chat waits for the same retry, so its messages keep their order, or fails with it
+            outcomes += [Outcome(later.id, False, outcome.error, outcome.retry_in) for later in messages[index + 1:]]
+            break
+        return outcomes
+
+    async def _settle(self, session_pool: async_sessionmaker, attempts: dict[int, int], outcomes: list[Outcome]):
+        now = datetime.now()
+        async with session_pool() as session:
+            sent = [outcome.message_id for outcome in outcomes if outcome.attempted and outcome.error is None]
+            if sent:
+                await session.execute(delete(OutboxMessage).where(OutboxMessage.id.in_(sent)))
+
+            for outcome in outcomes:
+                if outcome.attempted and outcome.error is None:
+                    continue
+                tries = attempts[outcome.message_id] + outcome.attempted
+                failed = outcome.retry_in is None or tries >= MAX_ATTEMPTS
+                if failed:
+                    logging.warning("Outbox message %s given up: %s", outcome.message_id, outcome.error)
+                await session.execute(
+                    update(OutboxMessage).where(OutboxMessage.id == outcome.message_id).values(
+                        attempts=tries,
+                        status='failed' if failed else 'pending',
+                        next_attempt_at=now + timedelta(seconds=outcome.retry_in or 0),
+                        last_error=outcome.error
+                    ).execution_options(synchronize_session=False)
+                )
+            await session.commit()
+
+
+notifier = Notifier()
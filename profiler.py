@@ -0,0 +1,172 @@
+import asyncio
+import cProfile
+import glob
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import tempfile
+import time
+from os import getenv
+from typing import Awaitable, NamedTuple, Optional
+
+PROFILE_DIR = getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'hairbot-profiles'))
+CONTROL_FILE = os.path.join(PROFILE_DIR, 'control.json')
+CONTROL_INTERVAL = 5  # seconds between checks of the control file and writes of new samples
+TOP_FUNCTIONS = 40  # Rows of a profile report
+
+
+class Settings(NamedTuple):
+    rate: float  # Share of the updates to profile, 0 turns profiling off
+    handler: Optional[str] = None  # Only this handler's updates, any handler if None
+
+
+OFF = Settings(0.0)
+
+
+def read_settings() -> Settings:
+    try:
+        with open(CONTROL_FILE) as file:
+            return Settings(**json.load(file))
+    except FileNotFoundError:
+        return OFF
+
+
+def write_settings(settings: Settings):
+    """Switches profiling in every bot process, they pick the file up within CONTROL_INTERVAL."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(CONTROL_FILE + '.tmp', 'w') as file:
+        json.dump(settings._asdict(), file)
+    os.replace(CONTROL_FILE + '.tmp', CONTROL_FILE)
+
+
+class Profiler:
+    """cProfile of a sample of the updates, summed per handler and written to PROFILE_DIR.
+
+    One update is profiled at a time. cProfile follows the thread, not the task, so other
+    updates running while the sampled one waits for the database show up in its profile
+    too. It also counts every resume of a coroutine as a call and leaves out the time it
+    is suspended, so the samples and their wall time are measured separately and written
+    next to the .prof file.
+    """
+
+    def __init__(self):
+        self.settings = OFF
+        self._busy = False
+        self._stats: dict[str, pstats.Stats] = {}
+        self._timings: dict[str, list] = {}  # handler -> [samples, wall seconds]
+        self._dirty: set[str] = set()
+        self._control_mtime: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def wants(self, handler: str) -> bool:
+        settings = self.settings
+        if not settings.rate or self._busy:
+            return False
+        if settings.handler is not None and settings.handler != handler:
+            return False
+        return random.random() < settings.rate
+
+    async def profile(self, handler: str, call: Awaitable):
+        profile = cProfile.Profile()
+        self._busy = True
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            return await call
+        finally:
+            profile.disable()
+            self._busy = False
+            timing = self._timings.setdefault(handler, [0, 0.0])
+            timing[0] += 1
+            timing[1] += time.perf_counter() - started
+            if handler in self._stats:
+                self._stats[handler].add(profile)
+            else:
+                self._stats[handler] = pstats.Stats(profile)
+            self._dirty.add(handler)
+
+    def apply(self, settings: Settings):
+        if settings != self.settings:
+            logging.info("Profiling %s of the updates of %s", settings.rate, settings.handler or 'all handlers')
+        self.settings = settings
+
+    def sync(self):
+        """Follows the control file and writes the profiles that got new samples."""
+        try:
+            mtime = os.stat(CONTROL_FILE).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._control_mtime:
+            self._control_mtime = mtime
+            self.apply(read_settings())
+
+        for handler in self._dirty:
+            # Stats hold everything this process collected, so the files are simply replaced
+            path = os.path.join(PROFILE_DIR, f'{handler}.{os.getpid()}.prof')
+            self._stats[handler].dump_stats(path)
+            samples, seconds = self._timings[handler]
+            with open(path + '.json.tmp', 'w') as file:
+                json.dump({'samples': samples, 'seconds': seconds}, file)
+            os.replace(path + '.json.tmp', path + '.json')
+        self._dirty.clear()
+
+    async def _sync_forever(self, interval):
+        while True:
+            try:
+                self.sync()
+            except (OSError, ValueError, TypeError) as e:
+                logging.warning("Profiler sync failed: %s", e)
+            await asyncio.sleep(interval)
+
+    def start(self, interval=CONTROL_INTERVAL):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        self._task = asyncio.create_task(self._sync_forever(interval))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+            self.sync()
+
+
+profiler = Profiler()
+
+
+def load(handler: str) -> Optional[pstats.Stats]:
+    """The handler's samples from all bot processes."""
+    paths = glob.glob(os.path.join(PROFILE_DIR, f'{glob.escape(handler)}.*.prof'))
+    return pstats.Stats(*paths) if paths else None
+
+
+def summaries() -> list[tuple[str, int, float]]:
+    """(handler, samples, wall seconds spent in them) of every profiled handler, slowest first."""
+    totals: dict[str, list] = {}
+    for path in glob.glob(os.path.join(PROFILE_DIR, '*.prof.json')):
+        try:
+            with open(path) as file:
+                timing = json.load(file)
+        except FileNotFoundError:
+            continue  # Deleted by clear() meanwhile
+        total = totals.setdefault(os.path.basename(path).split('.')[0], [0, 0.0])
+        total[0] += timing['samples']
+        total[1] += timing['seconds']
+    rows = [(handler, samples, seconds) for handler, (samples, seconds) in totals.items()]
+    return sorted(rows, key=lambda row: row[2] / (row[1] or 1), reverse=True)
+
+
+def report(handler: str, sort='cumulative', limit=TOP_FUNCTIONS) -> str:
+    stats = load(handler)
+    if stats is None:
+        return ''
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
+
+
+def clear():
+    for path in glob.glob(os.path.join(PROFILE_DIR, '*.prof')) + glob.glob(os.path.join(PROFILE_DIR, '*.prof.json')):
+        os.remove(path)
@@ -0,0 +1,99 @@
+import asyncio
+from contextvars import ContextVar
+
+# Set by background senders (ads) so their API calls yield to replies to users
+bulk_traffic: ContextVar[bool] = ContextVar('bulk_traffic', default=False)
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = None
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for `seconds`, e.g. after a `retry_after` from Telegram."""
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    def full(self) -> bool:
+        """True once the bucket has refilled completely, i.e. it would behave like a new one."""
+        if self._updated is None:
+            return True
+        now = asyncio.get_running_loop().time()
+        return now >= self._paused_until and self._tokens + (now - self._updated) * self.rate >= self.capacity
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                now = loop.time()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                if self._updated is not None:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class PriorityTokenBucket(TokenBucket):
+    """TokenBucket that serves waiting interactive callers before any bulk one.
+
+    Taking a token never awaits between the check and the decrement, so callers
+    compete without a lock and a bulk caller simply steps aside while the
+    interactive ones are waiting.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        super().__init__(rate, capacity)
+        self._interactive = 0
+        self._no_interactive = asyncio.Event()
+        self._no_interactive.set()
+
+    async def acquire(self, bulk: bool = False):
+        if bulk:
+            await self._take(bulk)
+            return
+
+        self._interactive += 1
+        self._no_interactive.clear()
+        try:
+            await self._take(bulk)
+        finally:
+            self._interactive -= 1
+            if not self._interactive:
+                self._no_interactive.set()
+
+    async def _take(self, bulk: bool):
+        loop = asyncio.get_running_loop()
+        while True:
+            if bulk and self._interactive:
+                await self._no_interactive.wait()
+                continue
+
+            now = loop.time()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            if self._updated is not None:
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
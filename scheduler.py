@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from os import getenv
+from typing import Any, NamedTuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.middlewares.user_context import UserContextMiddleware
+from aiogram.methods import GetUpdates, TelegramMethod
+from aiogram.types import Update
+
+import metrics
+
+WORKERS = int(getenv('UPDATE_WORKERS', 32))
+MAX_PENDING = 1000  # Polling stops fetching while this many updates wait
+POLLING_TIMEOUT = 10  # seconds, same as aiogram's start_polling
+MAX_BACKOFF = 30  # seconds between getUpdates attempts while Telegram is unreachable
+STATS_INTERVAL = 60  # seconds between stats log lines
+
+
+class SchedulerStats(NamedTuple):
+    pending: int  # Updates queued and not started yet
+    running: int
+    chats: int  # Chats with queued or running updates
+    deepest_chat: int  # Longest queue of a single chat
+    processed: int
+    wait_total: float  # Seconds from arrival to start, summed over processed updates
+    wait_max: float  # Longest wait since the previous stats(reset_max=True)
+
+
+class _Job(NamedTuple):
+    update: Update
+    future: asyncio.Future
+    queued_at: float
+    answer: bool
+
+
+class UpdateScheduler:
+    """Handles updates of different chats in parallel and updates of one chat strictly in order.
+
+    Updates are queued per (chat, user), the key of the FSM state, and a key is worked on by
+    one worker at a time, so `state.update_data` sequences of a booking never interleave.
+    At most `workers` updates run at once; a chat whose update finished goes to the back
+    of the line, so a chatty user can't starve the others.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers=WORKERS, max_pending=MAX_PENDING):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.workers = workers
+        self._slots = asyncio.Semaphore(max_pending)
+        self._chats: dict[Any, deque[_Job]] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()  # Keys with queued updates and no running one
+        self._tasks: list[asyncio.Task] = []
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._pending = 0
+        self._running = 0
+        self._processed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @staticmethod
+    def chat_key(update: Update):
+        context = UserContextMiddleware.resolve_event_context(update)
+        if context.chat is None and context.user is None:
+            return update.update_id  # Nothing to keep in order with
+        return context.chat and context.chat.id, context.user and context.user.id
+
+    async def submit(self, update: Update, answer=True) -> asyncio.Future:
+        """Queues the update behind the earlier ones of its chat.
+
+        Waits while the scheduler is full. The returned future resolves to the handler's
+        result; with `answer` a returned TelegramMethod is sent right away instead.
+        """
+        await self._slots.acquire()
+        job = _Job(update, asyncio.get_running_loop().create_future(), time.monotonic(), answer)
+        key = self.chat_key(update)
+        queue = self._chats.get(key)
+        if queue is None:
+            queue = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        queue.append(job)
+        self._pending += 1
+        self._idle.clear()
+        return job.future
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        """Lets started and queued updates finish for up to `timeout` seconds, then cancels the rest."""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Dropping %s unfinished updates", self._pending + self._running)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def stats(self, reset_max=False) -> SchedulerStats:
+        stats = SchedulerStats(
+            pending=self._pending,
+            running=self._running,
+            chats=len(self._chats),
+            deepest_chat=max(map(len, self._chats.values()), default=0),
+            processed=self._processed,
+            wait_total=self._wait_total,
+            wait_max=self._wait_max
+        )
+        if reset_max:
+            self._wait_max = 0.0
+        return stats
+
+    async def handle(self, update: Update, answer: bool) -> Any:
+        result = await self.dispatcher.feed_update(self.bot, update)
+        if answer and isinstance(result, TelegramMethod):
+            # Sent before the chat's next update starts, so replies keep their order too
+            await self.dispatcher.silent_call_request(self.bot, result)
+            return None
+        return result
+
+    async def _work(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._chats[key]
+            job = queue.popleft()
+
+            wait = time.monotonic() - job.queued_at
+            self._pending -= 1
+            self._running += 1
+            self._processed += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            metrics.update_wait_seconds.observe(wait)
+            try:
+                result = await self.handle(job.update, job.answer)
+                if not job.future.done():
+                    job.future.set_result(result)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._running -= 1
+                self._slots.release()
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+                if not self._pending and not self._running:
+                    self._idle.set()
+
+    async def run_polling(self, polling_timeout=POLLING_TIMEOUT, allowed_updates: list[str] | None = None):
+        """Long-polls getUpdates and feeds every update through the scheduler, never returns."""
+        if allowed_updates is None:
+            allowed_updates = self.dispatcher.resolve_used_update_types()
+        get_updates = GetUpdates(timeout=polling_timeout, allowed_updates=allowed_updates)
+        kwargs = {}
+        if self.bot.session.timeout:
+            # The request has to outlive the long poll itself
+            kwargs['request_timeout'] = int(self.bot.session.timeout + polling_timeout)
+
+        failures = 0
+        logged_at = time.monotonic()
+        while True:
+            try:
+                updates = await self.bot(get_updates, **kwargs)
+            except Exception as e:
+                failures += 1
+                delay = min(MAX_BACKOFF, 2 ** failures)
+                logging.warning("Failed to fetch updates (%s), retrying in %s s", e, delay)
+                await asyncio.sleep(delay)
+                continue
+            failures = 0
+
+            for update in updates:
+                (await self.submit(update)).add_done_callback(_log_failure)
+                # Confirms the update, handled or not it won't be fetched again
+                get_updates.offset = update.update_id + 1
+
+            if time.monotonic() - logged_at >= STATS_INTERVAL:
+                logged_at = time.monotonic()
+                stats = self.stats(reset_max=True)
+                logging.info(
+                    "Updates: %s pending in %s chats (deepest %s), %s running, %s processed, "
+                    "wait avg %.3f s max %.3f s",
+                    stats.pending, stats.chats, stats.deepest_chat, stats.running, stats.processed,
+                    stats.wait_total / (stats.processed or 1), stats.wait_max
+                )
+
+
+def _log_failure(future: asyncio.Future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error("Update failed", exc_info=future.exception())
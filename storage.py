@@ -0,0 +1,132 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, KeyBuilder, DefaultKeyBuilder
+from sqlalchemy import delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import metrics
+from models import FSMRecord
+
+FSM_TTL = timedelta(hours=24)  # Booking flows idle for longer are dropped
+SWEEP_INTERVAL = 600  # seconds
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'dirty')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None):
+        self.state = state
+        self.data = data or {}
+        self.dirty = False
+
+
+class SQLAlchemyStorage(BaseStorage):
+    """FSM storage kept in the project's database (Postgres, or SQLite for tests).
+
+    A key is read at most once per update and its changes are buffered until
+    `flush(key)`, which FSMFlushMiddleware calls after the handler, so every
+    step costs at most one write. Nothing stays cached between updates, so
+    several bot processes can share the table.
+    """
+
+    def __init__(self, session_pool: async_sessionmaker, ttl: timedelta = FSM_TTL,
+                 key_builder: Optional[KeyBuilder] = None):
+        self.session_pool = session_pool
+        self.ttl = ttl
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self._pending: Dict[str, _Record] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+
+    async def _record(self, key: StorageKey) -> _Record:
+        storage_key = self.key_builder.build(key)
+        record = self._pending.get(storage_key)
+        if record is None:
+            async with self.session_pool() as session:
+                row = await session.get(FSMRecord, storage_key)
+            if row is None or row.updated_at < datetime.now() - self.ttl:
+                record = _Record()
+            else:
+                record = _Record(row.state, json.loads(row.data) if row.data else {})
+            self._pending[storage_key] = record
+        return record
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        state = state.state if isinstance(state, State) else state
+        if state is not None and state != record.state:
+            metrics.fsm_entered.inc(state)
+        record.state = state
+        record.dirty = True
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._record(key)
+        record.data = data.copy()
+        record.dirty = True
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(key)).data.copy()
+
+    async def flush(self, key: StorageKey) -> None:
+        """Writes the buffered changes of the key with one statement and forgets it."""
+        record = self._pending.pop(self.key_builder.build(key), None)
+        if record is None or not record.dirty:
+            return
+
+        storage_key = self.key_builder.build(key)
+        async with self.session_pool() as session:
+            if record.state is None and not record.data:
+                await session.execute(delete(FSMRecord).filter(FSMRecord.key == storage_key))
+            else:
+                insert = postgresql.insert if session.bind.dialect.name == 'postgresql' else sqlite.insert
+                values = {
+                    'key': storage_key,
+                    'state': record.state,
+                    'data': json.dumps(record.data, ensure_ascii=False, separators=(',', ':')),
+                    'updated_at': datetime.now()
+                }
+                statement = insert(FSMRecord).values(**values)
+                await session.execute(statement.on_conflict_do_update(
+                    index_elements=[FSMRecord.key],
+                    set_={column: statement.excluded[column] for column in ('state', 'data', 'updated_at')}
+                ))
+            await session.commit()
+
+    async def sweep(self) -> int:
+        """Deletes all records idle for longer than the TTL in one statement.
+
+        The state each one was left in counts as an abandoned step of that flow.
+        """
+        async with self.session_pool() as session:
+            states = (await session.scalars(
+                delete(FSMRecord).filter(FSMRecord.updated_at < datetime.now() - self.ttl).returning(FSMRecord.state)
+            )).all()
+            await session.commit()
+        for state in states:
+            if state is not None:
+                metrics.fsm_abandoned.inc(state)
+        return len(states)
+
+    async def start_sweeper(self, interval=SWEEP_INTERVAL):
+        self._sweeper = asyncio.create_task(self._sweep_forever(interval))
+
+    async def _sweep_forever(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logging.warning("FSM sweep failed: %s", e)
+
+    async def close(self) -> None:
+        if self._sweeper:
+            self._sweeper.cancel()
+            self._sweeper = None
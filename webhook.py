@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from os import getenv
+
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response, JSONResponse
+from starlette.routing import Route
+
+from handlers import dp
+from main import create_bot, method_payload
+from migrations import upgrade_schema
+from scheduler import UpdateScheduler
+
+load_dotenv()
+WEBHOOK_PATH = getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = getenv('WEBHOOK_URL')  # Public https base url, the webhook is registered on startup if set
+WEBHOOK_SECRET = getenv('WEBHOOK_SECRET')
+
+REPLY_TIMEOUT = 55  # seconds, Telegram waits 60 for the webhook response
+
+bot = create_bot()
+scheduler = UpdateScheduler(dp, bot)
+
+
+def send_late_reply(future: asyncio.Future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    if isinstance(future.result(), TelegramMethod):
+        asyncio.ensure_future(dp.silent_call_request(bot, future.result()))
+
+
+async def telegram_webhook(request: Request) -> Response:
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return Response(status_code=401)
+
+    update = Update.model_validate(await request.json(), context={'bot': bot})
+    # Telegram sends updates over parallel connections, the scheduler keeps each chat in order
+    future = await scheduler.submit(update, answer=False)
+    try:
+        result = await asyncio.wait_for(asyncio.shield(future), REPLY_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Telegram would resend the update, so answer now and send the reply when it is ready
+        future.add_done_callback(send_late_reply)
+        return Response()
+    if not isinstance(result, TelegramMethod):
+        return Response()
+
+    # A method returned by the handler is sent back as the webhook reply, saving a separate API request
+    payload, files = method_payload(bot, result)
+    if files:
+        # Uploads can't be sent in a JSON reply
+        await dp.silent_call_request(bot, result)
+        return Response()
+    return JSONResponse(payload)
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    upgrade_schema()
+    await dp.emit_startup(bot=bot, dispatcher=dp)
+    scheduler.start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logging.info("Webhook is set to %s", WEBHOOK_URL + WEBHOOK_PATH)
+    yield
+    await scheduler.stop()
+    await dp.emit_shutdown(bot=bot, dispatcher=dp)
+    await bot.session.close()
+
+
+routes = [Route(WEBHOOK_PATH, telegram_webhook, methods=['POST'])]
+
+# Serve it with one worker only: `uvicorn webhook:app`. Per-chat ordering (scheduler.UpdateScheduler), the FSM
+# write buffer of storage.SQLAlchemyStorage and the background tasks of the startup are all per process, and
+# Telegram's parallel connections would hand updates of one chat to different workers. For several processes
+# run `python -m cluster front --webhook --spawn N`, which routes every chat to a fixed worker.
+app = Starlette(routes=routes, lifespan=lifespan)